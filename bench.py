@@ -0,0 +1,225 @@
+# Benchmarks of uno.Game, unoparser and stored games, to keep the engine from
+# getting slower. Games are played with fixed seeds, so every run measures
+# the same positions, and results can be written as JSON to compare runs.
+
+import argparse
+import copy
+import json
+import pickle
+import platform
+import random
+import timeit
+import tracemalloc
+
+import uno
+import unoparser
+
+## Positions
+
+def make_position(seed, num_players, num_plays, condition=None):
+
+	# A game after some random plays, or after the first play where the
+	# condition is true, trying the next seeds until one gets there
+	for game_seed in range(seed, seed + 1000):
+		rng = random.Random(game_seed)
+
+		game = uno.Game()
+		game.apply_configs(uno.DEFAULT_CONFIGS)
+		game.begin(num_players, seed=game_seed)
+
+		while game.winner is None:
+			if condition is None and game.current_play_number >= num_plays:
+				return game
+			if condition is not None and game.current_play_number >= num_plays and condition(game):
+				return game
+
+			intents = [intent for intent in game.get_play_intents(game.current_player) if intent.can_play]
+			intent = rng.choice(intents)
+			new_color = rng.choice(uno.COLORS) if intent.action == uno.ACTION_PLAY and intent.card.color == uno.NO_COLOR else None
+			game.play(game.current_player, uno.Play(intent.action, intent.card, new_color))
+
+	raise RuntimeError('No game got to the position')
+
+def make_huge_hand(game, num_cards):
+	# The current player takes most of the draw pile
+	player = game.current_player
+	draw_pile = game.draw_pile
+	game.set_hand(player, game.sorted_hands[player] + draw_pile[-num_cards:])
+	game.set_piles(draw_pile[:-num_cards], game.discard_pile)
+	return game
+
+def make_empty_draw_pile(game):
+	# Every card of the draw pile goes under the current card
+	discard_pile = game.discard_pile
+	game.set_piles(b'', game.draw_pile + discard_pile)
+	return game
+
+def get_legal_play(game):
+	face = next(uno.get_mask_faces(game.legal_moves(game.current_player).cards))
+	card = uno.CARD_FACES[face]
+	return uno.Play(uno.ACTION_PLAY, card, uno.COLOR_RED if card.color == uno.NO_COLOR else None)
+
+## Benchmarks
+
+# Each benchmark gets the arguments and returns a function doing the measured
+# operation once. Operations that change the game restore it first, and
+# 'restore' is measured alone to tell how much of their time that is.
+
+def bench_begin(args):
+	game = uno.Game()
+	return lambda: game.begin(args.players, seed=args.seed)
+
+def bench_play(action, condition):
+	def bench(args):
+		game = make_position(args.seed, args.players, args.plays, condition)
+		snapshot = game.snapshot()
+		play = get_legal_play(game) if action == uno.ACTION_PLAY else uno.Play(action, None, None)
+
+		def run():
+			game.restore(snapshot)
+			game.play(game.current_player, play)
+		return run
+	return bench
+
+def bench_restore(args):
+	game = make_position(args.seed, args.players, args.plays)
+	snapshot = game.snapshot()
+	return lambda: game.restore(snapshot)
+
+def bench_reshuffle(args):
+	game = make_empty_draw_pile(make_position(args.seed, args.players, args.plays))
+	snapshot = game.snapshot()
+
+	def run():
+		game.restore(snapshot)
+		game.pick_card()
+	return run
+
+def bench_intents(num_cards):
+	def bench(args):
+		game = make_position(args.seed, args.players, args.plays)
+		if num_cards:
+			make_huge_hand(game, num_cards)
+		return lambda: list(game.get_play_intents_cards(game.current_player))
+	return bench
+
+def bench_legal_moves(num_cards):
+	def bench(args):
+		game = make_position(args.seed, args.players, args.plays)
+		if num_cards:
+			make_huge_hand(game, num_cards)
+		return lambda: game.legal_moves(game.current_player)
+	return bench
+
+def bench_parse_play(args):
+	return lambda: (unoparser.parse_play('g6'), unoparser.parse_play('+4 y'), unoparser.parse_play('d'))
+
+def bench_intent_list_string(args):
+	game = make_position(args.seed, args.players, args.plays)
+	return lambda: unoparser.play_intent_list_string(game.get_play_intents_cards(game.current_player))
+
+def bench_hand_string(args):
+	game = make_position(args.seed, args.players, args.plays)
+	player = game.current_player
+	return lambda: unoparser.hand_string(game.get_player_faces(player), game.legal_moves(player).cards)
+
+def bench_copy(copy_game):
+	def bench(args):
+		game = make_position(args.seed, args.players, args.plays)
+		return lambda: copy_game(game)
+	return bench
+
+BENCHMARKS = {
+	'begin': bench_begin,
+	'play_card': bench_play(uno.ACTION_PLAY, lambda game: game.legal_moves(game.current_player).cards),
+	'play_draw': bench_play(uno.ACTION_DRAW, lambda game: game.legal_moves(game.current_player).can_draw),
+	'play_pass': bench_play(uno.ACTION_PASS, lambda game: game.legal_moves(game.current_player).can_pass),
+	'play_call_bluff': bench_play(uno.ACTION_CALL_BLUFF, lambda game: game.legal_moves(game.current_player).can_call_bluff),
+	'restore': bench_restore,
+	'reshuffle': bench_reshuffle,
+	'intents_small_hand': bench_intents(0),
+	'intents_huge_hand': bench_intents(60),
+	'legal_moves_small_hand': bench_legal_moves(0),
+	'legal_moves_huge_hand': bench_legal_moves(60),
+	'parse_play': bench_parse_play,
+	'intent_list_string': bench_intent_list_string,
+	'hand_string': bench_hand_string,
+	'clone': bench_copy(lambda game: game.clone()),
+	'snapshot': bench_copy(lambda game: game.snapshot()),
+	'deepcopy': bench_copy(copy.deepcopy),
+	'bytes_round_trip': bench_copy(lambda game: uno.Game.from_bytes(game.to_bytes())),
+	'pickle_round_trip': bench_copy(lambda game: pickle.loads(pickle.dumps(game))),
+}
+
+## Measuring
+
+def measure(run, repeat):
+
+	timer = timeit.Timer(run)
+	number, elapsed = timer.autorange()
+	best = min([elapsed] + timer.repeat(repeat - 1, number)) if repeat > 1 else elapsed
+
+	# Memory taken at the peak of one run, past what was there before it
+	tracemalloc.start()
+	run()
+	before = tracemalloc.get_traced_memory()[0]
+	tracemalloc.reset_peak()
+	run()
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+
+	return {
+		'us_per_op': best / number * 1e6,
+		'ops_per_sec': number / best,
+		'peak_bytes': peak - before,
+	}
+
+def compare(results, old_results):
+	for name, result in results.items():
+		old_result = old_results.get(name)
+		if old_result:
+			change = old_result['us_per_op'] / result['us_per_op']
+			print('{:<24} {:>10.2f} us {:>10.2f} us {:>6.2f}x'.format(name, old_result['us_per_op'], result['us_per_op'], change))
+
+def main():
+
+	parser = argparse.ArgumentParser(description='Benchmark uno.Game.')
+	parser.add_argument('names', nargs='*', metavar='NAME', help='benchmarks to run (default: all), out of: ' + ', '.join(BENCHMARKS))
+	parser.add_argument('--players', type=int, default=4, help='number of players')
+	parser.add_argument('--plays', type=int, default=30, help='plays made before measuring')
+	parser.add_argument('--seed', type=int, default=0, help='seed of the measured games')
+	parser.add_argument('--repeat', type=int, default=3, help='times each measure is taken, the best is kept')
+	parser.add_argument('--json', metavar='FILE', help='write results to this file')
+	parser.add_argument('--compare', metavar='FILE', help='compare with results written before')
+	args = parser.parse_args()
+
+	for name in args.names:
+		if name not in BENCHMARKS:
+			parser.error('Unknown benchmark ' + name)
+
+	results = {}
+
+	for name in args.names or BENCHMARKS:
+		result = results[name] = measure(BENCHMARKS[name](args), args.repeat)
+		print('{:<24} {:>10.2f} us {:>12.0f}/sec {:>8} bytes'.format(name, result['us_per_op'], result['ops_per_sec'], result['peak_bytes']))
+
+	if args.json:
+		with open(args.json, 'w') as file:
+			json.dump({
+				'python': platform.python_version(),
+				'players': args.players,
+				'plays': args.plays,
+				'seed': args.seed,
+				'results': results,
+			}, file, indent='\t')
+
+	if args.compare:
+		with open(args.compare) as file:
+			old = json.load(file)
+
+		print()
+		print('Compared with ' + args.compare + ' (before, now, speedup):')
+		compare(results, old['results'])
+
+if __name__ == "__main__":
+	main()
@@ -26,8 +26,8 @@ SET default_table_access_method = heap;
 
 CREATE TABLE public.uno_joins (
     id integer NOT NULL,
-    room_id integer,
-    user_id integer,
+    room_id integer NOT NULL,
+    user_id integer NOT NULL,
     player_number integer
 );
 
@@ -52,6 +52,38 @@ CREATE SEQUENCE public.uno_joins_id_seq
 ALTER SEQUENCE public.uno_joins_id_seq OWNED BY public.uno_joins.id;
 
 
+--
+-- Name: uno_moves; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.uno_moves (
+    id integer NOT NULL,
+    room_id integer NOT NULL,
+    play_number integer NOT NULL,
+    play smallint NOT NULL
+);
+
+
+--
+-- Name: uno_moves_id_seq; Type: SEQUENCE; Schema: public; Owner: -
+--
+
+CREATE SEQUENCE public.uno_moves_id_seq
+    AS integer
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1;
+
+
+--
+-- Name: uno_moves_id_seq; Type: SEQUENCE OWNED BY; Schema: public; Owner: -
+--
+
+ALTER SEQUENCE public.uno_moves_id_seq OWNED BY public.uno_moves.id;
+
+
 --
 -- Name: uno_rooms; Type: TABLE; Schema: public; Owner: -
 --
@@ -65,7 +97,9 @@ CREATE TABLE public.uno_rooms (
     allow_play_non_drawn_cards text DEFAULT 'false'::text NOT NULL,
     allow_pass_without_draw text DEFAULT 'false'::text NOT NULL,
     draw_pass_behavior text DEFAULT 'single_draw'::text NOT NULL,
-    allow_highlight_playable_cards text DEFAULT 'false'::text NOT NULL
+    allow_highlight_playable_cards text DEFAULT 'false'::text NOT NULL,
+    snapshot_play_number integer DEFAULT 0 NOT NULL,
+    version integer DEFAULT 0 NOT NULL
 );
 
 
@@ -128,6 +162,13 @@ ALTER SEQUENCE public.uno_users_id_seq OWNED BY public.uno_users.id;
 ALTER TABLE ONLY public.uno_joins ALTER COLUMN id SET DEFAULT nextval('public.uno_joins_id_seq'::regclass);
 
 
+--
+-- Name: uno_moves id; Type: DEFAULT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.uno_moves ALTER COLUMN id SET DEFAULT nextval('public.uno_moves_id_seq'::regclass);
+
+
 --
 -- Name: uno_rooms id; Type: DEFAULT; Schema: public; Owner: -
 --
@@ -150,6 +191,38 @@ ALTER TABLE ONLY public.uno_joins
     ADD CONSTRAINT uno_joins_pkey PRIMARY KEY (id);
 
 
+--
+-- Name: uno_joins uno_joins_room_id_player_number_key; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.uno_joins
+    ADD CONSTRAINT uno_joins_room_id_player_number_key UNIQUE (room_id, player_number) DEFERRABLE INITIALLY DEFERRED;
+
+
+--
+-- Name: uno_joins uno_joins_user_id_key; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.uno_joins
+    ADD CONSTRAINT uno_joins_user_id_key UNIQUE (user_id);
+
+
+--
+-- Name: uno_moves uno_moves_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.uno_moves
+    ADD CONSTRAINT uno_moves_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: uno_moves uno_moves_room_id_play_number_key; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.uno_moves
+    ADD CONSTRAINT uno_moves_room_id_play_number_key UNIQUE (room_id, play_number);
+
+
 --
 -- Name: uno_rooms uno_rooms_pkey; Type: CONSTRAINT; Schema: public; Owner: -
 --
@@ -174,6 +247,22 @@ ALTER TABLE ONLY public.uno_users
     ADD CONSTRAINT uq_uno_users_user_id UNIQUE (user_id);
 
 
+--
+-- Name: uno_joins uno_joins_room_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.uno_joins
+    ADD CONSTRAINT uno_joins_room_id_fkey FOREIGN KEY (room_id) REFERENCES public.uno_rooms(id) ON DELETE CASCADE;
+
+
+--
+-- Name: uno_moves uno_moves_room_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.uno_moves
+    ADD CONSTRAINT uno_moves_room_id_fkey FOREIGN KEY (room_id) REFERENCES public.uno_rooms(id) ON DELETE CASCADE;
+
+
 --
 -- PostgreSQL database dump complete
 --
@@ -1,18 +1,97 @@
 # Telegram bot webhook code
 
+from collections import namedtuple
 import logging
 import os
 import random
+import threading
+import time
 
 import uno, unoparser
 from plural import plural
+import metrics
+import roomqueue
 import server
+import unobot
 
 from telegram import ParseMode, ReplyKeyboardMarkup, ReplyKeyboardRemove
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
+from telegram.ext import Updater, CommandHandler, MessageHandler, TypeHandler, Filters
 from telegram.error import TelegramError, Unauthorized, BadRequest, TimedOut, ChatMigrated, NetworkError
 
 bot = None
+dispatcher = None
+
+# Play picked by a bot, put in the update queue to be made by the dispatcher
+BotTurn = namedtuple('BotTurn', ['room_id', 'user_id', 'seed', 'play_number', 'play'])
+
+# Bot turns being thought in this process, by room, game seed and play number
+thinking_bot_turns = set()
+thinking_lock = threading.Lock()
+
+def wrap_handler(handler, get_room_key=None):
+	# Each update is timed, handled in its own database transaction, and
+	# after the updates of the same room that came before it
+	return queue_handler(metrics.time_handler(server.in_transaction(handler)), get_room_key or get_update_room_key)
+
+def queue_handler(handler, get_room_key):
+
+	def queued_handler(update, context):
+
+		def run():
+			try:
+				handler(update, context)
+			except Exception as e:
+				dispatcher.dispatch_error(update, e)
+
+		def route():
+			# Users the cache didn't know of wait for their room from here on
+			try:
+				with server.transaction():
+					room_id = server.get_current_room(update.message.from_user.id)
+			except Exception as e:
+				dispatcher.dispatch_error(update, e)
+				return
+
+			if room_id is None:
+				run()
+			else:
+				submit_update(update, room_id, run)
+
+		key = get_room_key(update, context)
+		submit_update(update, key, route if is_user_key(key) else run)
+
+	return queued_handler
+
+def submit_update(update, key, job):
+
+	# Bot turns are always queued, as nobody would send them again
+	if not roomqueue.submit(key, job, limit=not isinstance(update, BotTurn)):
+		metrics.increment('uno_room_queue_rejected_total')
+		if getattr(update, 'message', None):
+			send_message(update.message.from_user.id, 'Too much is going on in your room right now, try again in a moment.',
+				reply_markup=ReplyKeyboardRemove())
+
+def get_update_room_key(update, context):
+
+	if isinstance(update, BotTurn):
+		return update.room_id
+
+	# Only the cache is looked at in the dispatcher's thread, so it never waits
+	# for the database. Users it doesn't know of are queued by themselves, and
+	# their room is looked up from there.
+	user_id = update.message.from_user.id
+	room_id = server.get_cached_user_room_id(user_id)
+
+	return room_id if room_id is not None else ('user', user_id)
+
+def is_user_key(key):
+	return isinstance(key, tuple)
+
+def get_join_room_key(update, context):
+
+	# Joins wait for the room being joined, not the one the user is in
+	room_id = string_to_positive_integer(context.args[0]) if context.args else None
+	return room_id if room_id is not None else get_update_room_key(update, context)
 
 def main():
 
@@ -20,41 +99,69 @@ def main():
 	TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
 	TELEGRAM_BOT_WEBHOOK = os.environ.get('TELEGRAM_BOT_WEBHOOK')
 	PORT = os.environ.get('PORT')
+	BOT_MOVE_TIME_MS = os.environ.get('BOT_MOVE_TIME_MS')
+	BOT_WORKERS = os.environ.get('BOT_WORKERS')
+	METRICS_PORT = os.environ.get('METRICS_PORT')
+	ROOM_WORKERS = os.environ.get('ROOM_WORKERS')
 
 	# Enable logging
 	logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 	logger = logging.getLogger(__name__)
 
+	# Database, which works without the constraints but slowly and less safely
+	missing_constraints = server.get_missing_constraints()
+	if missing_constraints:
+		logger.warning('Database is missing %s, run the updates in sql-updates', ', '.join(missing_constraints))
+
 	## Bot setup
 	# Set up the Updater
 	updater = Updater(TELEGRAM_BOT_TOKEN, use_context=True)
 
 	global bot
-	bot = updater.bot
+	bot = metrics.TimedCalls(updater.bot, 'telegram')
+
+	# Metrics, only reachable from the same machine
+	metrics.set_gauge_function('uno_active_games', server.count_active_games)
+	metrics.set_gauge_function('uno_room_cache_rooms', lambda: len(server.room_cache))
+	metrics.set_gauge_function('uno_room_cache_bytes', lambda: server.room_cache_bytes)
+	metrics.set_gauge_function('uno_room_queue_updates', roomqueue.count_queued)
+	if METRICS_PORT:
+		metrics.start_server(int(METRICS_PORT))
+
+	# Bot players search in their own processes
+	if BOT_MOVE_TIME_MS:
+		unobot.TIME_BUDGET = int(BOT_MOVE_TIME_MS) / 1000
+	unobot.start_workers(int(BOT_WORKERS) if BOT_WORKERS else None)
+
+	# Updates are handled by room in these threads, not in the dispatcher's
+	roomqueue.start(int(ROOM_WORKERS) if ROOM_WORKERS else None)
 
 	## Handlers
-	dp = updater.dispatcher
+	global dispatcher
+	dp = dispatcher = updater.dispatcher
 
 	# Command handlers
-	dp.add_handler(CommandHandler('start', handler_start))
-	dp.add_handler(CommandHandler('help', handler_help))
-	dp.add_handler(CommandHandler('settings', handler_settings))
+	dp.add_handler(CommandHandler('start', wrap_handler(handler_start)))
+	dp.add_handler(CommandHandler('help', wrap_handler(handler_help)))
+	dp.add_handler(CommandHandler('settings', wrap_handler(handler_settings)))
 
-	dp.add_handler(CommandHandler('status', handler_status))
-	dp.add_handler(CommandHandler('new', handler_new))
-	dp.add_handler(CommandHandler('join', handler_join))
-	dp.add_handler(CommandHandler('leave', handler_leave))
-	dp.add_handler(CommandHandler('begin', handler_begin))
-	dp.add_handler(CommandHandler('end', handler_end))
+	dp.add_handler(CommandHandler('status', wrap_handler(handler_status)))
+	dp.add_handler(CommandHandler('new', wrap_handler(handler_new)))
+	dp.add_handler(CommandHandler('join', wrap_handler(handler_join, get_join_room_key)))
+	dp.add_handler(CommandHandler('leave', wrap_handler(handler_leave)))
+	dp.add_handler(CommandHandler('begin', wrap_handler(handler_begin)))
+	dp.add_handler(CommandHandler('end', wrap_handler(handler_end)))
+	dp.add_handler(CommandHandler('bot', wrap_handler(handler_bot)))
 
-	dp.add_handler(CommandHandler('chat', handler_chat))
-	dp.add_handler(CommandHandler('configs', handler_configs))
+	dp.add_handler(CommandHandler('chat', wrap_handler(handler_chat)))
+	dp.add_handler(CommandHandler('configs', wrap_handler(handler_configs)))
 
 	# secret
-	dp.add_handler(CommandHandler('error', handler_error))
+	dp.add_handler(CommandHandler('error', wrap_handler(handler_error)))
 
 	# Message handlers
-	dp.add_handler(MessageHandler(Filters.text & Filters.chat_type.private, handler_text_message))
+	dp.add_handler(MessageHandler(Filters.text & Filters.chat_type.private, wrap_handler(handler_text_message)))
+	dp.add_handler(TypeHandler(BotTurn, wrap_handler(handler_bot_turn)))
 
 	dp.add_error_handler(error_handler)
 
@@ -69,7 +176,7 @@ def handler_start(update, context):
 	handler_help(update, context)
 
 def handler_help(update, context):
-	update.message.reply_text(help_text(), parse_mode=ParseMode.HTML, disable_web_page_preview=True, reply_markup=ReplyKeyboardRemove())
+	send_message(update.message.chat_id, help_text(), parse_mode=ParseMode.HTML, disable_web_page_preview=True, reply_markup=ReplyKeyboardRemove())
 
 def handler_settings(update, context):
 	
@@ -106,7 +213,7 @@ def handler_settings(update, context):
 			if value in server.all_settings[setting]:
 
 				server.update_user_settings(user_id, setting, value)
-				server.commit()
+				server.after_commit(lambda: server.invalidate_user_settings(user_id))
 
 				text += 'Setting set.\n'
 			else:
@@ -114,16 +221,27 @@ def handler_settings(update, context):
 		else:
 			text += 'This setting does not exist!\n'
 
-	update.message.reply_text(text, reply_markup=ReplyKeyboardRemove())
+	send_message(update.message.chat_id, text, reply_markup=ReplyKeyboardRemove())
 
 def handler_status(update, context):
 
 	user_id = update.message.from_user.id
 
-	settings = get_and_apply_user_settings(user_id)
-	text = get_status_text(server.get_current_room(user_id), user_id)
+	room = server.load_room_context(user_id)
+
+	if room:
+		profile = get_render_profile(room.settings[user_id], room.configs)
+	else:
+		profile = get_render_profile(server.get_user_settings(user_id))
+
+	text = get_status_text(room, user_id, profile)
 
-	bot.send_message(user_id, text, parse_mode=ParseMode.HTML, reply_markup=ReplyKeyboardRemove())
+	send_message(user_id, text, parse_mode=ParseMode.HTML, reply_markup=ReplyKeyboardRemove())
+
+	# Bot turns lost to a restart or an error are started again
+	if room and room.game:
+		apply_room_configs(room.configs, room.game)
+		start_bot_turn(room)
 
 def handler_new(update, context):
 	
@@ -134,14 +252,13 @@ def handler_new(update, context):
 	if current_room_id == None:
 		room_id = server.insert_room()
 		server.insert_user_to_room(room_id, user_id)
-		server.commit()
 
 		text += 'Created and joined room ' + str(room_id) + '.\n'
 	
 	else:
 		text = 'You are already in room ' + str(current_room_id) + '! You must /leave that room first.\n'
 
-	update.message.reply_text(text, reply_markup=ReplyKeyboardRemove())
+	send_message(update.message.chat_id, text, reply_markup=ReplyKeyboardRemove())
 
 def handler_join(update, context):
 
@@ -155,7 +272,9 @@ def handler_join(update, context):
 		if room_id != None:
 
 			current_room_id = server.get_current_room(user_id)
-			room_exists = server.check_room_exists(room_id)
+
+			# The game is checked with the room locked, so it can't begin before the user is in
+			room_exists = server.lock_room(room_id)
 			game = None
 
 			if current_room_id:
@@ -171,7 +290,6 @@ def handler_join(update, context):
 
 			if not current_room_id and room_exists and not game:
 				server.insert_user_to_room(room_id, user_id)
-				server.commit()
 
 				text += 'Joined room ' + str(room_id) + '.\n'
 				text_to_all += get_user_name(user_id) + ' joined the room.\n'
@@ -182,7 +300,7 @@ def handler_join(update, context):
 	else:
 		text += 'You have not said the room you want to join! Try /join <room number>\n'
 
-	update.message.reply_text(text, reply_markup=ReplyKeyboardRemove())
+	send_message(update.message.chat_id, text, reply_markup=ReplyKeyboardRemove())
 	send_message_to_room(room_id, text_to_all)
 
 def handler_leave(update, context):
@@ -190,6 +308,7 @@ def handler_leave(update, context):
 	text, text_to_all = '', ''
 	user_id = update.message.from_user.id
 	room_id = server.get_current_room(user_id)
+	room_user_ids = None
 
 	if room_id:
 
@@ -201,23 +320,23 @@ def handler_leave(update, context):
 
 			text += 'You have left room number '+str(room_id)+'.\n'
 
-			if server.check_room_empty(room_id):
+			# Bots don't stay in a room by themselves, they go with it
+			room_user_ids = server.select_users_ids_in_room(room_id)
+			if all(unobot.is_bot(room_user_id) for room_user_id in room_user_ids):
 				server.delete_room(room_id)
 
 				text += 'The room was empty with your departure, so it has been deleted.\n'
 			else:
 				text_to_all += get_user_name(user_id) + ' left the room.\n'
 
-			server.commit()
-
 		else:
 			text += 'A game is being played in this room! Someone must /end it before anyone can leave.\n'
 		
 	else:
 		text += 'You are not in any room right now!\n'
 
-	update.message.reply_text(text, reply_markup=ReplyKeyboardRemove())
-	send_message_to_room(room_id, text_to_all)
+	send_message(update.message.chat_id, text, reply_markup=ReplyKeyboardRemove())
+	send_message_to_room(room_id, text_to_all, user_ids=room_user_ids)
 
 def handler_begin(update, context):
 
@@ -239,28 +358,32 @@ def handler_begin(update, context):
 		configs = server.get_room_configs(room_id)
 		apply_room_configs(configs, game)
 
-		game.begin(len(users))
+		with metrics.phase('engine'):
+			game.begin(len(users))
+
+			numbers = list(range(len(users)))
+			game.get_random().shuffle(numbers)
 
 		server.update_game(room_id, game)
 
-		numbers = list(range(len(users)))
-		random.shuffle(numbers)
+		server.update_player_numbers(room_id, {for_user_id: numbers.pop() for for_player_number, for_user_id in users})
 
-		for for_player_number, for_user_id in users:
-			server.update_player_number(room_id, for_user_id, numbers.pop())
+		room_user_ids = [for_user_id for for_player_number, for_user_id in users]
 
-		server.commit()
+		send_message_to_room(room_id, text_to_all, user_ids=room_user_ids)
 
-		send_message_to_room(room_id, text_to_all)
+		room = server.load_room_context(user_id)
 
 		def get_user_status_text(user_id):
-			settings = get_and_apply_user_settings(user_id)
-			return get_status_text(room_id, user_id, show_room_info=False)
+			profile = get_render_profile(room.settings[user_id], room.configs)
+			return get_status_text(room, user_id, profile, show_room_info=False)
 
-		send_message_to_room(room_id, get_user_status_text, parse_mode=ParseMode.HTML)
+		send_message_to_room(room_id, get_user_status_text, parse_mode=ParseMode.HTML, user_ids=room_user_ids)
+
+		start_bot_turn(room)
 
 	else:
-		update.message.reply_text("You cannot begin the game if you are not in a room! Try /new or /join <room number>", reply_markup=ReplyKeyboardRemove())
+		send_message(update.message.chat_id, "You cannot begin the game if you are not in a room! Try /new or /join <room number>", reply_markup=ReplyKeyboardRemove())
 
 def handler_end(update, context):
 	
@@ -273,15 +396,58 @@ def handler_end(update, context):
 
 		if game:
 			server.update_game(room_id, None)
-			server.commit()
 
 			send_message_to_room(room_id, get_user_name(user_id) + ' has ended the game')
 
 		else:
-			update.message.reply_text("But there is no game going on!", reply_markup=ReplyKeyboardRemove())
+			send_message(update.message.chat_id, "But there is no game going on!", reply_markup=ReplyKeyboardRemove())
+
+	else:
+		send_message(update.message.chat_id, "You cannot end the game if you are not in a room! Try /new or /join <room number>", reply_markup=ReplyKeyboardRemove())
+
+def handler_bot(update, context):
+
+	text, text_to_all = '', ''
+	user_id = update.message.from_user.id
+	room_id = server.get_current_room(user_id)
+
+	removing = len(context.args) > 0 and context.args[0].lower() == 'remove'
+
+	if room_id:
+
+		game = server.select_game(room_id)
+		bot_user_ids = [room_user_id for room_user_id in server.select_users_ids_in_room(room_id) if unobot.is_bot(room_user_id)]
+		bot_numbers = [unobot.get_bot_number(bot_user_id) for bot_user_id in bot_user_ids]
+
+		if game:
+			text += 'A game is being played in this room! Someone must /end it before bots can join or leave.\n'
+
+		elif removing:
+			if bot_user_ids:
+				bot_user_id = unobot.make_bot_user_id(room_id, max(bot_numbers))
+				server.delete_user_from_room(bot_user_id)
+
+				text_to_all += get_user_name(bot_user_id) + ' left the room.\n'
+			else:
+				text += 'There are no bots in this room!\n'
+
+		else:
+			free_numbers = [number for number in range(unobot.MAX_BOTS_PER_ROOM) if number not in bot_numbers]
+
+			if free_numbers:
+				bot_user_id = unobot.make_bot_user_id(room_id, free_numbers[0])
+				server.insert_user_to_room(room_id, bot_user_id)
+
+				text_to_all += get_user_name(bot_user_id) + ' joined the room.\n'
+			else:
+				text += 'This room already has as many bots as it can!\n'
 
 	else:
-		update.message.reply_text("You cannot end the game if you are not in a room! Try /new or /join <room number>", reply_markup=ReplyKeyboardRemove())
+		text += 'You cannot add or remove bots if you are not in a room! Try /new or /join <room number>\n'
+
+	if text:
+		send_message(update.message.chat_id, text, reply_markup=ReplyKeyboardRemove())
+	send_message_to_room(room_id, text_to_all)
 
 def handler_chat(update, context):
 
@@ -334,7 +500,13 @@ def handler_configs(update, context):
 				if value in server.all_configs[config]:
 
 					server.update_room_config(room_id, config, value)
-					server.commit()
+
+					# Store the game whole, so plays after this are replayed with the new config
+					game = server.select_game(room_id)
+					if game:
+						configs[config] = value
+						apply_room_configs(configs, game)
+						server.update_game(room_id, game)
 
 					send_message_to_room(room_id,
 						get_user_name(user_id) + ' set room configuration ' + config + ' to ' + value + '\n')
@@ -350,45 +522,48 @@ def handler_configs(update, context):
 		text += 'You cannot change room configuration if you are not in a room!\n'
 	
 	if text:
-		update.message.reply_text(text, reply_markup=reply_markup)
+		send_message(update.message.chat_id, text, reply_markup=reply_markup)
 
 def handler_error(update, context):
 
 	user_id = update.message.from_user.id
-	bot.send_message(user_id, get_error_message(), reply_markup=ReplyKeyboardRemove())
+	send_message(user_id, get_error_message(), reply_markup=ReplyKeyboardRemove())
 
 def handler_text_message(update, context):
 	
 	user_id = update.message.from_user.id
-	room_id = server.get_current_room(user_id)
 
 	message = update.message.text
 
 	# Check if it is a chat message
 	if (len(message) > 0 and message[0] == "."):
-		command_chat(update, user_id, room_id, message[1:])
+		command_chat(update, user_id, server.get_current_room(user_id), message[1:])
 		return
 
-	if room_id:
+	room = server.load_room_context(user_id)
 
-		game = server.select_game(room_id)
-		player_number = server.select_player_number(room_id, user_id)
+	if room:
+
+		game = room.game
+		player_number = room.player_number
 	
 		if game:
 
-			configs = server.get_room_configs(room_id)
-			apply_room_configs(configs, game)
+			apply_room_configs(room.configs, game)
 
 			# Check if someone has already won the game
 			if game.winner != None:
-				winner_user_id = server.select_user_id_from_player_number(room_id, game.winner)
-				update.message.reply_text(get_user_name(winner_user_id) + ' already won this game! You cannot play anymore. Try /begin', reply_markup=ReplyKeyboardRemove())
+				winner_user_id = server.get_room_user_id(room, game.winner)
+				send_message(update.message.chat_id, get_user_name(winner_user_id) + ' already won this game! You cannot play anymore. Try /begin', reply_markup=ReplyKeyboardRemove())
 				return
 
 			# Check if is the current player
 			if game.current_player != player_number:
-				current_user_id = server.select_user_id_from_player_number(room_id, game.current_player)
-				update.message.reply_text('It is not your turn! The current player is ' + get_user_name(current_user_id), reply_markup=ReplyKeyboardRemove())
+				current_user_id = server.get_room_user_id(room, game.current_player)
+				send_message(update.message.chat_id, 'It is not your turn! The current player is ' + get_user_name(current_user_id), reply_markup=ReplyKeyboardRemove())
+
+				# Bot turns lost to a restart or an error are started again
+				start_bot_turn(room)
 				return
 
 			# Try to parse the user text
@@ -396,67 +571,43 @@ def handler_text_message(update, context):
 				play = unoparser.parse_play(message)
 
 			except unoparser.InputParsingError as e:
-				update.message.reply_text('That is not how you play! ' + str(e) + ' And try reading /help', reply_markup=ReplyKeyboardRemove())
+				send_message(update.message.chat_id, 'That is not how you play! ' + str(e) + ' And try reading /help', reply_markup=ReplyKeyboardRemove())
 				return
 
-			bluffed_player = game.previous_player
-
 			# Execute the play
-			play_result = game.play(player_number, play)
+			play_result = make_play(room, user_id, player_number, play)
 
 			# If failed, send reason
 			if not play_result.success:
 				fail_reason = unoparser.fail_reason_string(play_result.fail_reason)
-				update.message.reply_text(fail_reason, reply_markup=ReplyKeyboardRemove())
+				send_message(update.message.chat_id, fail_reason, reply_markup=ReplyKeyboardRemove())
 				return
 
-			if play_result.draw_pile_has_emptied:
-				send_message_to_room(room_id,
-					'The draw pile does not have enough cards, cards from the discard pile have been shuffled into the draw pile.', reply_markup=ReplyKeyboardRemove())
-
-			# Store game in database
-			server.update_game(room_id, game)
-			server.commit()
-
-			# Send info messages
-
-			current_user_id = server.select_user_id_from_player_number(room_id, game.current_player)
-
-			user_name = get_user_name(user_id)
+		else:
+			send_message(update.message.chat_id, 'There is no game going on! Try /begin', reply_markup=ReplyKeyboardRemove())
 
-			if play_result.action == uno.ACTION_CALL_BLUFF:
-				bluffed_user_id = server.select_user_id_from_player_number(room_id, bluffed_player)
-				bluffed_user_name = get_user_name(bluffed_user_id)
-			else:
-				bluffed_user_name = None
+	else:
+		send_message(update.message.chat_id, 'You cannot play if you are not in a room! Try /new or /join <room number>', reply_markup=ReplyKeyboardRemove())
 
-			# For all users in room...
-			for room_user_id in server.select_users_ids_in_room(room_id):
-				settings = get_and_apply_user_settings(room_user_id)
+def handler_bot_turn(turn, context):
 
-				# Send made play
-				play_number_text = ''
-				if settings.get('show_play_number', 'false') == 'true':
-					play_number_text = '#' + str(game.current_play_number) + ': '
+	# Bots are in uno_joins like everyone else
+	room = server.load_room_context(turn.user_id)
+	game = room.game if room else None
 
-				play_result_text = play_number_text + unoparser.play_result_string(play_result, user_name, bluffed_user_name)
-				bot.send_message(room_user_id, play_result_text, reply_markup=ReplyKeyboardRemove())
+	# The game may have been ended, begun again or played on while the bot was thinking
+	if not game or game.seed != turn.seed or game.current_play_number != turn.play_number or game.winner != None:
+		return
 
-				# Send if someone won
-				if game.winner != None:
-					bot.send_message(room_user_id, user_name + ' won.', reply_markup=ReplyKeyboardRemove())
-					continue
+	if room.player_number != game.current_player:
+		return
 
-				# Send status to current player
-				if room_user_id == current_user_id:
-					text = get_status_text(room_id, room_user_id, show_your_turn=True, show_room_info=False)
-					bot.send_message(room_user_id, text, parse_mode=ParseMode.HTML, reply_markup=ReplyKeyboardRemove())
+	apply_room_configs(room.configs, game)
 
-		else:
-			update.message.reply_text('There is no game going on! Try /begin', reply_markup=ReplyKeyboardRemove())
+	play_result = make_play(room, turn.user_id, game.current_player, turn.play)
 
-	else:
-		update.message.reply_text('You cannot play if you are not in a room! Try /new or /join <room number>', reply_markup=ReplyKeyboardRemove())
+	if not play_result.success:  # this is never supposed to happen!
+		logging.error('Bot play %s failed in room %s: %s', turn.play, turn.room_id, play_result.fail_reason)
 
 def error_handler(update, context):
 	try:
@@ -480,7 +631,9 @@ def error_handler(update, context):
 		# handle all other telegram related errors
 		logging.exception('Uncaught')
 	except Exception as e:
-		bot.send_message(update.message.from_user.id, get_error_message(), reply_markup=ReplyKeyboardRemove())
+		# Bot turns have no one to answer to
+		if getattr(update, 'message', None):
+			send_message(update.message.from_user.id, get_error_message(), reply_markup=ReplyKeyboardRemove())
 		logging.exception('Uncaught')
 
 ## Helper functions
@@ -496,6 +649,7 @@ def help_text():
 		"/leave - Leave a room\n"
 		"/begin - Begin game\n"
 		"/end - End game\n"
+		"/bot - Add a bot to the room, /bot remove to remove one\n"
 		"/chat or . - Send a message to all in room\n"
 		"/settings - Change user settings\n"
 		"/configs - Change room configurations\n"
@@ -521,7 +675,117 @@ def command_chat(update, user_id, room_id, message):
 
 	else:
 		text = 'You cannot send chat messages if you are not in a room!'
-		update.message.reply_text(text, reply_markup=ReplyKeyboardRemove())
+		send_message(update.message.chat_id, text, reply_markup=ReplyKeyboardRemove())
+
+def make_play(room, user_id, player_number, play):
+
+	room_id, game = room.room_id, room.game
+	bluffed_player = game.previous_player
+
+	with metrics.phase('engine'):
+		play_result = game.play(player_number, play)
+
+	if not play_result.success:
+		return play_result
+
+	metrics.increment('uno_plays_total', labels={'action': PLAY_ACTION_NAMES[play_result.action],
+		'player': 'bot' if unobot.is_bot(user_id) else 'user'})
+
+	if play_result.draw_pile_has_emptied:
+		send_message_to_room(room_id,
+			'The draw pile does not have enough cards, cards from the discard pile have been shuffled into the draw pile.',
+			user_ids=[room_user_id for for_player_number, room_user_id in room.users])
+
+	# Store play in database
+	server.insert_play(room_id, game, play)
+
+	# Send info messages
+
+	current_user_id = server.get_room_user_id(room, game.current_player)
+
+	user_name = get_user_name(user_id)
+
+	if play_result.action == uno.ACTION_CALL_BLUFF:
+		bluffed_user_id = server.get_room_user_id(room, bluffed_player)
+		bluffed_user_name = get_user_name(bluffed_user_id)
+	else:
+		bluffed_user_name = None
+
+	# For all users in room...
+	for for_player_number, room_user_id in room.users:
+		if unobot.is_bot(room_user_id):
+			continue
+
+		profile = get_render_profile(room.settings[room_user_id], room.configs)
+
+		# Send made play
+		play_number_text = ''
+		if profile.show_play_number:
+			play_number_text = '#' + str(game.current_play_number) + ': '
+
+		with metrics.phase('render'):
+			play_result_text = play_number_text + unoparser.play_result_string(play_result, user_name, bluffed_user_name, profile)
+		send_message(room_user_id, play_result_text, reply_markup=ReplyKeyboardRemove())
+
+		# Send if someone won
+		if game.winner != None:
+			send_message(room_user_id, user_name + ' won.', reply_markup=ReplyKeyboardRemove())
+			continue
+
+		# Send status to current player
+		if room_user_id == current_user_id:
+			text = get_status_text(room, room_user_id, profile, show_your_turn=True, show_room_info=False)
+			send_message(room_user_id, text, parse_mode=ParseMode.HTML, reply_markup=ReplyKeyboardRemove())
+
+	start_bot_turn(room)
+
+	return play_result
+
+def start_bot_turn(room):
+
+	game = room.game
+
+	if game.winner != None:
+		return
+
+	user_id = server.get_room_user_id(room, game.current_player)
+
+	# Bots think outside of the dispatcher, and their play comes back to it as an update
+	if unobot.is_bot(user_id):
+		game = game.clone()
+		server.after_commit(lambda: dispatch_bot_turn(room.room_id, user_id, game))
+
+def dispatch_bot_turn(room_id, user_id, game):
+
+	# Turns can be started again while still being thought, and are only thought once
+	turn = (room_id, game.seed, game.current_play_number)
+
+	with thinking_lock:
+		if turn in thinking_bot_turns:
+			return
+		thinking_bot_turns.add(turn)
+
+	dispatcher.run_async(think_bot_turn, turn, user_id, game)
+
+def think_bot_turn(turn, user_id, game):
+	try:
+		start = time.perf_counter()
+		play = unobot.choose_play(game, game.current_player)
+		metrics.observe('uno_bot_think_seconds', time.perf_counter() - start)
+
+	finally:
+		with thinking_lock:
+			thinking_bot_turns.discard(turn)
+
+	room_id, seed, play_number = turn
+	dispatcher.update_queue.put(BotTurn(room_id, user_id, seed, play_number, play))
+
+PLAY_ACTION_NAMES = {
+	uno.ACTION_PLAY: 'play',
+	uno.ACTION_DRAW: 'draw',
+	uno.ACTION_PASS: 'pass',
+	uno.ACTION_CALL_BLUFF: 'call_bluff',
+}
 
 def string_to_positive_integer(string):
 	try:
@@ -533,32 +797,45 @@ def string_to_positive_integer(string):
 		return number
 	return None
 
-def send_message_to_room(room_id, text, not_me=None, parse_mode=None):
+def send_message(chat_id, text, **kwargs):
+	# Sent once the handler's changes are committed, so handlers run again
+	# after a conflict don't send anything twice
+	server.after_commit(lambda: bot.send_message(chat_id, text, **kwargs))
+
+def send_message_to_room(room_id, text, not_me=None, parse_mode=None, user_ids=None):
+	# Users in the room can be given when already known
 	if text and room_id:
-		for user_id in server.select_users_ids_in_room(room_id):
-			if user_id != not_me:
+		if user_ids is None:
+			user_ids = server.select_users_ids_in_room(room_id)
+
+		for user_id in user_ids:
+			if user_id != not_me and not unobot.is_bot(user_id):
 
 				if callable(text):
 					new_text = text(user_id)
 					if new_text:
-						bot.send_message(user_id, new_text, parse_mode=parse_mode, disable_web_page_preview=True, reply_markup=ReplyKeyboardRemove())
+						send_message(user_id, new_text, parse_mode=parse_mode, disable_web_page_preview=True, reply_markup=ReplyKeyboardRemove())
 				else:
-					bot.send_message(user_id, text, parse_mode=parse_mode, disable_web_page_preview=True, reply_markup=ReplyKeyboardRemove())
+					send_message(user_id, text, parse_mode=parse_mode, disable_web_page_preview=True, reply_markup=ReplyKeyboardRemove())
+
+def get_status_text(room, user_id, profile, show_room_info=True, show_your_turn=False):
+	with metrics.phase('render'):
+		return make_status_text(room, user_id, profile, show_room_info, show_your_turn)
 
-def get_status_text(room_id, user_id, show_room_info=True, show_your_turn=False):
+def make_status_text(room, user_id, profile, show_room_info, show_your_turn):
 
 	text = ''
 
-	if room_id:
-		users = server.select_users_info_in_room(room_id)
-		game = server.select_game(room_id)
+	if room:
+		users = list(room.users)
+		game = room.game
 		
-		configs = server.get_room_configs(room_id)
-		apply_room_configs(configs, game)
+		if game:
+			apply_room_configs(room.configs, game)
 
 		if show_room_info:
 			num_users = len(users)
-			text += ('You are currently in room number ' + str(room_id)
+			text += ('You are currently in room number ' + str(room.room_id)
 				+ ', which has ' + str(num_users) + ' ' + plural(num_users, 'user', 'users') + '.\n')
 
 		if show_your_turn:
@@ -573,7 +850,7 @@ def get_status_text(room_id, user_id, show_room_info=True, show_your_turn=False)
 			for_user_name = get_user_name(for_user_id)
 
 			if game:
-				num_cards = len(game.player_cards[for_player_number])
+				num_cards = game.num_player_cards(for_player_number)
 				text += (str(for_player_number) + ': ' + for_user_name
 					+ ' (' + str(num_cards) + ' ' + plural(num_cards, 'card', 'cards') + ')')
 
@@ -592,16 +869,16 @@ def get_status_text(room_id, user_id, show_room_info=True, show_your_turn=False)
 
 		if game:
 
-			text += 'Current card: ' + unoparser.card_string(game.current_card) + '\n'
+			text += 'Current card: ' + unoparser.card_string(game.current_card, profile) + '\n'
 			if game.current_color != game.current_card.color:
-				text += 'Chosen color: ' + unoparser.card_color_string(game.current_color) + '\n'
+				text += 'Chosen color: ' + unoparser.card_color_string(game.current_color, profile) + '\n'
 
 			player_number = next((for_player_number for for_player_number, for_user_id in users if for_user_id == user_id))
 
 			text += 'Your cards: '
 
-			if len(game.player_cards[player_number]) != 0:
-				text += unoparser.play_intent_list_string(game.get_play_intents_cards(player_number))
+			if game.num_player_cards(player_number) != 0:
+				text += unoparser.hand_string(game.get_player_faces(player_number), game.legal_moves(player_number).cards, profile)
 			else:
 				text += 'None!'
 
@@ -633,32 +910,17 @@ def get_error_message():
 		"I am error.",
 	))
 
-def get_and_apply_user_settings(user_id):
-
-	settings = server.get_user_settings(user_id)
-
-	style = settings.get('style', 'short')
-
-	if style == 'short':
-		unoparser.COLOR_STRINGS = unoparser.COLOR_STRINGS_SHORT
-		unoparser.KIND_STRINGS = unoparser.KIND_STRINGS_SHORT
-	elif style == 'emoji':
-		unoparser.COLOR_STRINGS = unoparser.COLOR_STRINGS_EMOJI
-		unoparser.KIND_STRINGS = unoparser.KIND_STRINGS_SHORT
-	elif style == 'circle':
-		unoparser.COLOR_STRINGS = unoparser.COLOR_STRINGS_CIRCLE
-		unoparser.KIND_STRINGS = unoparser.KIND_STRINGS_SHORT
-	elif style == 'heart':
-		unoparser.COLOR_STRINGS = unoparser.COLOR_STRINGS_HEART
-		unoparser.KIND_STRINGS = unoparser.KIND_STRINGS_SHORT
-	elif style == 'long':
-		unoparser.COLOR_STRINGS = unoparser.COLOR_STRINGS_LONG
-		unoparser.KIND_STRINGS = unoparser.KIND_STRINGS_LONG
-
-	return settings
+def get_render_profile(settings, configs=None):
+	# Style and play numbers are the user's choice, highlighting is the room's
+	return unoparser.get_render_profile(settings.get('style', 'short'),
+		bool(configs) and configs.get('allow_highlight_playable_cards') == 'true',
+		settings.get('show_play_number', 'false') == 'true')
 
 def get_user_name(user_id):
 
+	if unobot.is_bot(user_id):
+		return unobot.get_bot_name(user_id)
+
 	chat = bot.get_chat(user_id)
 
 	if chat.username:
@@ -670,16 +932,8 @@ def get_user_name(user_id):
 	return '({}) {}'.format(user_id, chat.first_name)
 
 def apply_room_configs(configs, game):
-	# Set room configs (TODO maybe automatically do this)
-	game.draw_4_on_draw_4 = (configs.get('draw_4_on_draw_4') == 'true')
-	game.draw_2_on_draw_4 = (configs.get('draw_2_on_draw_4'))
-	game.disable_call_bluff = (configs.get('disable_call_bluff') == 'true')
-	game.allow_play_non_drawn_cards = (configs.get('allow_play_non_drawn_cards') == 'true')
-	game.allow_pass_without_draw = (configs.get('allow_pass_without_draw') == 'true')
-	game.draw_pass_behavior = (configs.get('draw_pass_behavior'))
-
-	# game.allow_highlight_playable_cards = (configs.get('allow_highlight_playable_cards') == 'true')
-	unoparser.HIGHLIGHT_PLAYABLE = (configs.get('allow_highlight_playable_cards') == 'true')
+	# Set room configs
+	game.apply_configs(configs)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,232 @@
+# Metrics of the bot: counters, gauges and histograms kept in memory, and
+# shown in the Prometheus text format on a local HTTP endpoint.
+# Handlers are timed as a whole and by phase (database, engine, rendering,
+# Telegram API), where phases inside other phases only count their own time.
+
+import bisect
+import collections
+import contextlib
+import http.server
+import logging
+import threading
+import time
+
+# Upper bounds of histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Quantiles shown for the most recent observations of each histogram
+QUANTILES = (0.5, 0.9, 0.99)
+NUM_RECENT = 1024
+
+HELP = {
+	'uno_updates_total': 'Updates handled, by handler.',
+	'uno_handler_errors_total': 'Updates whose handler raised an exception, by handler.',
+	'uno_handler_seconds': 'Time taken by each handler.',
+	'uno_handler_phase_seconds': 'Time taken by each phase of each handler.',
+	'uno_plays_total': 'Plays made, by action.',
+	'uno_bot_think_seconds': 'Time taken by bots to pick a play.',
+	'uno_active_games': 'Rooms with a game going on.',
+	'uno_room_cache_total': 'Rooms looked up in the room cache, by whether they were in it.',
+	'uno_room_cache_rooms': 'Rooms in the room cache.',
+	'uno_room_cache_bytes': 'Approximate memory taken by the rooms in the room cache.',
+	'uno_settings_cache_total': 'Users looked up in the settings cache, by whether they were in it.',
+	'uno_room_conflicts_total': 'Handlers run again because a room they wrote was changed meanwhile.',
+	'uno_room_queue_updates': 'Updates waiting or being handled in room queues.',
+	'uno_room_queue_rejected_total': 'Updates dropped because their room queue was full.',
+}
+
+lock = threading.Lock()
+counters = collections.defaultdict(float)
+histograms = {}
+gauge_functions = {}
+
+local = threading.local()
+
+## Recording
+
+def get_key(name, labels):
+	return name, tuple(sorted(labels.items())) if labels else ()
+
+def increment(name, amount=1, labels=None):
+	key = get_key(name, labels)
+	with lock:
+		counters[key] += amount
+
+def observe(name, value, labels=None):
+	key = get_key(name, labels)
+	with lock:
+		histogram = histograms.get(key)
+		if histogram is None:
+			histogram = histograms[key] = Histogram()
+		histogram.observe(value)
+
+def set_gauge_function(name, function):
+	# Gauges are read when metrics are shown
+	gauge_functions[name] = function
+
+class Histogram():
+
+	def __init__(self):
+		self.bucket_counts = [0] * (len(BUCKETS) + 1)
+		self.count = 0
+		self.sum = 0.0
+		self.recent = collections.deque(maxlen=NUM_RECENT)
+
+	def observe(self, value):
+		self.bucket_counts[bisect.bisect_left(BUCKETS, value)] += 1
+		self.count += 1
+		self.sum += value
+		self.recent.append(value)
+
+	def get_quantile(self, quantile):
+		values = sorted(self.recent)
+		return values[min(int(quantile * len(values)), len(values) - 1)]
+
+## Timing
+
+@contextlib.contextmanager
+def phase(name):
+
+	# Time spent in a phase is added to the handler running in this thread.
+	# The phase around this one is paused until this one ends.
+	stack = getattr(local, 'stack', None)
+	if stack is None:
+		yield
+		return
+
+	now = time.perf_counter()
+	if stack:
+		add_phase_time(stack[-1][0], now - stack[-1][1])
+	stack.append([name, now])
+
+	try:
+		yield
+	finally:
+		now = time.perf_counter()
+		name, start = stack.pop()
+		add_phase_time(name, now - start)
+		if stack:
+			stack[-1][1] = now
+
+def add_phase_time(name, elapsed):
+	local.phase_times[name] = local.phase_times.get(name, 0.0) + elapsed
+
+def time_handler(handler, name=None):
+
+	name = name or handler.__name__
+
+	def timed_handler(update, context):
+		local.stack = []
+		local.phase_times = {}
+		start = time.perf_counter()
+
+		try:
+			with phase('other'):
+				return handler(update, context)
+		except Exception:
+			increment('uno_handler_errors_total', labels={'handler': name})
+			raise
+		finally:
+			increment('uno_updates_total', labels={'handler': name})
+			observe('uno_handler_seconds', time.perf_counter() - start, labels={'handler': name})
+			for phase_name, elapsed in local.phase_times.items():
+				observe('uno_handler_phase_seconds', elapsed, labels={'handler': name, 'phase': phase_name})
+			local.stack = None
+
+	return timed_handler
+
+class TimedCalls():
+
+	# Calls to methods of the object go in a phase, like a bot's API calls
+	def __init__(self, obj, phase_name):
+		self._obj = obj
+		self._phase_name = phase_name
+
+	def __getattr__(self, name):
+		attribute = getattr(self._obj, name)
+		if not callable(attribute):
+			return attribute
+
+		def timed_call(*args, **kwargs):
+			with phase(self._phase_name):
+				return attribute(*args, **kwargs)
+
+		return timed_call
+
+## Showing
+
+def get_text():
+
+	lines = []
+	helped = set()
+
+	def add_help(name, kind):
+		if name not in helped:
+			helped.add(name)
+			if name in HELP:
+				lines.append('# HELP {} {}'.format(name, HELP[name]))
+			lines.append('# TYPE {} {}'.format(name, kind))
+
+	with lock:
+		for (name, labels), value in sorted(counters.items()):
+			add_help(name, 'counter')
+			lines.append('{}{} {}'.format(name, labels_string(labels), format_value(value)))
+
+		for (name, labels), histogram in sorted(histograms.items(), key=lambda item: item[0]):
+			add_help(name, 'histogram')
+			cumulative = 0
+			for bound, count in zip(BUCKETS + (float('inf'),), histogram.bucket_counts):
+				cumulative += count
+				lines.append('{}_bucket{} {}'.format(name, labels_string(labels + (('le', format_value(bound)),)), cumulative))
+			lines.append('{}_count{} {}'.format(name, labels_string(labels), histogram.count))
+			lines.append('{}_sum{} {}'.format(name, labels_string(labels), format_value(histogram.sum)))
+
+		for (name, labels), histogram in sorted(histograms.items(), key=lambda item: item[0]):
+			if histogram.recent:
+				add_help(name + '_recent', 'summary')
+				for quantile in QUANTILES:
+					lines.append('{}_recent{} {}'.format(name, labels_string(labels + (('quantile', str(quantile)),)),
+						format_value(histogram.get_quantile(quantile))))
+
+	for name, function in sorted(gauge_functions.items()):
+		try:
+			value = function()
+		except Exception:
+			logging.exception('Could not read gauge ' + name)
+			continue
+		add_help(name, 'gauge')
+		lines.append('{} {}'.format(name, format_value(value)))
+
+	return '\n'.join(lines) + '\n'
+
+def labels_string(labels):
+	if not labels:
+		return ''
+	return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels) + '}'
+
+def format_value(value):
+	if value == float('inf'):
+		return '+Inf'
+	return repr(float(value))
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+
+	def do_GET(self):
+		if self.path != '/metrics':
+			self.send_error(404)
+			return
+
+		body = get_text().encode()
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+def start_server(port, host='127.0.0.1'):
+	server = http.server.ThreadingHTTPServer((host, port), MetricsRequestHandler)
+	thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+	thread.start()
+	return server
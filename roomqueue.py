@@ -0,0 +1,66 @@
+# Work queues by room: updates of the same room are handled one at a time and
+# in the order they came, while different rooms are handled at once by a pool
+# of worker threads. Each queue holds a limited number of updates, so a busy
+# room can't take up all the workers' time.
+
+import collections
+import concurrent.futures
+import logging
+import threading
+
+# Worker threads handling updates, and updates waiting in each room at most
+NUM_WORKERS = 4
+MAX_QUEUE_DEPTH = 20
+
+executor = None
+
+# Jobs of each key, the first one running. Keys only have a queue while they have jobs.
+queues = {}
+lock = threading.Lock()
+
+def start(workers=None):
+	global executor
+	if executor is None:
+		executor = concurrent.futures.ThreadPoolExecutor(workers or NUM_WORKERS, thread_name_prefix='room')
+	return executor
+
+def submit(key, job, limit=True):
+
+	# Returns False, without running the job, if the key's queue is full.
+	# Jobs that must run anyway are queued without a limit.
+	with lock:
+		queue = queues.get(key)
+
+		if queue is None:
+			queues[key] = collections.deque((job,))
+		elif limit and len(queue) >= MAX_QUEUE_DEPTH:
+			return False
+		else:
+			queue.append(job)
+			return True
+
+	# The first job of a key starts a worker on its queue, which goes on until it's empty
+	start().submit(run_queue, key)
+	return True
+
+def run_queue(key):
+
+	while True:
+		with lock:
+			job = queues[key][0]
+
+		try:
+			job()
+		except Exception:
+			logging.exception('Uncaught in room queue')
+
+		with lock:
+			queue = queues[key]
+			queue.popleft()
+			if not queue:
+				del queues[key]
+				return
+
+def count_queued():
+	with lock:
+		return sum(len(queue) for queue in queues.values())
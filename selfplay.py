@@ -0,0 +1,211 @@
+# Self-play harness, plays many full uno.Game games between player policies
+# on a process pool and reports speed, game length and win rates.
+# Every game only depends on its seed, so results are the same for any
+# number of workers.
+
+import argparse
+from collections import namedtuple
+import itertools
+import multiprocessing
+import random
+import time
+
+import uno
+import unobot
+
+## Policies
+
+# A policy gets the game, the player it plays for and a random generator,
+# and returns the uno.Play to make. It must be a legal play.
+
+def policy_random(game, player, rng):
+
+	intents = [intent for intent in game.get_play_intents(player) if intent.can_play]
+	intent = rng.choice(intents)
+
+	return intent_to_play(intent, rng.choice(uno.COLORS))
+
+def policy_greedy(game, player, rng):
+
+	# First highlighted card, or else whatever action is possible
+	for intent in game.get_play_intents(player):
+		if intent.can_play:
+			return intent_to_play(intent, most_common_color(game, player))
+
+def policy_hold_draw_4(game, player, rng):
+
+	# Like greedy, but +4s are only played when no other card can be
+	draw_4_intent = None
+
+	for intent in game.get_play_intents(player):
+		if intent.can_play:
+			if intent.action == uno.ACTION_PLAY and intent.card.kind == uno.KIND_DRAW_4:
+				if not draw_4_intent:
+					draw_4_intent = intent
+				continue
+
+			if intent.action != uno.ACTION_PLAY and draw_4_intent:
+				break
+
+			return intent_to_play(intent, most_common_color(game, player))
+
+	return intent_to_play(draw_4_intent, most_common_color(game, player))
+
+def policy_ismcts(game, player, rng):
+
+	# The bot's search, in this process and for a number of iterations
+	# instead of a time, so games stay the same for any machine
+	visits = unobot.search(game.to_bytes(), player, max_iterations=ISMCTS_ITERATIONS, seed=rng.getrandbits(64))
+	return uno.decode_play(unobot.get_best_code(visits))
+
+ISMCTS_ITERATIONS = 100
+
+POLICIES = {
+	'random': policy_random,
+	'greedy': policy_greedy,
+	'hold_draw_4': policy_hold_draw_4,
+	'ismcts': policy_ismcts,
+}
+
+def intent_to_play(intent, new_color):
+	if intent.action == uno.ACTION_PLAY and intent.card.color == uno.NO_COLOR:
+		return uno.Play(intent.action, intent.card, new_color)
+	return uno.Play(intent.action, intent.card, None)
+
+def most_common_color(game, player):
+	colors = game.hand_summary(player).colors
+	return max(uno.COLORS, key=lambda color: colors[color])
+
+## Games
+
+GameResult = namedtuple('GameResult', ['seed', 'winner', 'num_plays', 'ran_out'])
+Task = namedtuple('Task', ['configs', 'seeds', 'num_players', 'policies', 'max_plays'])
+Summary = namedtuple('Summary', ['num_games', 'num_ran_out', 'total_plays', 'wins_per_seat'])
+
+def play_game(seed, num_players, policies, configs, max_plays):
+
+	rng = random.Random(seed)
+
+	game = uno.Game()
+	game.apply_configs(configs)
+	game.begin(num_players, seed=seed)
+
+	try:
+		while game.winner is None and game.current_play_number < max_plays:
+
+			player = game.current_player
+			play = POLICIES[policies[player]](game, player, rng)
+
+			play_result = game.play(player, play)
+			if not play_result.success:
+				raise RuntimeError('Policy {} made an illegal play {} ({})'.format(policies[player], play, play_result.fail_reason))
+
+	except IndexError:
+		# Every card is in someone's hand
+		return GameResult(seed, None, game.current_play_number, True)
+
+	return GameResult(seed, game.winner, game.current_play_number, False)
+
+def run_task(task):
+
+	num_games, num_ran_out, total_plays = 0, 0, 0
+	wins_per_seat = [0] * task.num_players
+
+	for seed in task.seeds:
+		result = play_game(seed, task.num_players, task.policies, task.configs, task.max_plays)
+
+		num_games += 1
+		num_ran_out += result.ran_out
+		total_plays += result.num_plays
+		if result.winner is not None:
+			wins_per_seat[result.winner] += 1
+
+	return task.configs, Summary(num_games, num_ran_out, total_plays, wins_per_seat)
+
+def make_tasks(config_sets, num_games, num_players, policies, max_plays, seed, chunk_size):
+
+	# Seeds are the same for every config set, so configs are compared on the same games
+	for configs in config_sets:
+		for start in range(0, num_games, chunk_size):
+			seeds = range(seed + start, seed + min(start + chunk_size, num_games))
+			yield Task(configs, seeds, num_players, policies, max_plays)
+
+def make_config_sets(config_strings, vary_strings):
+
+	base = {**uno.DEFAULT_CONFIGS, **uno.parse_configs(config_strings)}
+
+	varied = []
+	for vary_string in vary_strings:
+		config, values = vary_string.split('=', 1)
+		varied.append([(config, value) for value in values.split(',')])
+
+	config_sets = []
+	for combination in itertools.product(*varied):
+		configs = dict(base)
+		configs.update(uno.parse_configs(config + '=' + value for config, value in combination))
+		config_sets.append(configs)
+
+	return config_sets
+
+def add_summaries(a, b):
+	return Summary(a.num_games + b.num_games, a.num_ran_out + b.num_ran_out, a.total_plays + b.total_plays,
+		[x + y for x, y in zip(a.wins_per_seat, b.wins_per_seat)])
+
+def main():
+
+	parser = argparse.ArgumentParser(description='Play many UNO games between computer policies.')
+	parser.add_argument('--games', type=int, default=1000, help='number of games per config set')
+	parser.add_argument('--policies', default='random,random,random,random',
+		help='comma separated policy per seat, out of: ' + ', '.join(POLICIES))
+	parser.add_argument('--config', action='append', default=[], metavar='CONFIG=VALUE', help='room config, can be repeated')
+	parser.add_argument('--vary', action='append', default=[], metavar='CONFIG=VALUE,VALUE',
+		help='compare values of a room config, can be repeated')
+	parser.add_argument('--seed', type=int, default=0, help='seed of the first game')
+	parser.add_argument('--max-plays', type=int, default=1000, help='plays after which a game is given up')
+	parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per CPU)')
+	parser.add_argument('--chunk-size', type=int, default=50, help='games per task sent to a worker')
+	args = parser.parse_args()
+
+	policies = args.policies.split(',')
+	for policy in policies:
+		if policy not in POLICIES:
+			parser.error('Unknown policy ' + policy)
+
+	num_players = len(policies)
+	config_sets = make_config_sets(args.config, args.vary)
+	tasks = make_tasks(config_sets, args.games, num_players, policies, args.max_plays, args.seed, args.chunk_size)
+
+	summaries = {}
+
+	start_time = time.perf_counter()
+
+	with multiprocessing.Pool(args.workers) as pool:
+		for configs, summary in pool.imap_unordered(run_task, tasks):
+			key = tuple(sorted(configs.items()))
+			if key in summaries:
+				summaries[key] = add_summaries(summaries[key], summary)
+			else:
+				summaries[key] = summary
+
+	elapsed = time.perf_counter() - start_time
+
+	num_games = sum(summary.num_games for summary in summaries.values())
+	total_plays = sum(summary.total_plays for summary in summaries.values())
+
+	print('Games: {} in {:.1f}s ({:.0f} games/sec, {:.0f} plays/sec)'.format(
+		num_games, elapsed, num_games / elapsed, total_plays / elapsed))
+
+	for configs in config_sets:
+		summary = summaries[tuple(sorted(configs.items()))]
+		num_finished = sum(summary.wins_per_seat)
+
+		changed = ['{}={}'.format(k, v) for k, v in configs.items() if v != uno.DEFAULT_CONFIGS[k]]
+		print()
+		print('Configs: ' + (', '.join(changed) or 'defaults'))
+		print('Average plays: {:.1f}'.format(summary.total_plays / summary.num_games))
+		print('Unfinished: {} ({} ran out of cards)'.format(summary.num_games - num_finished, summary.num_ran_out))
+		for seat, wins in enumerate(summary.wins_per_seat):
+			print('Seat {} ({}) wins: {:.1%}'.format(seat, policies[seat], wins / max(num_finished, 1)))
+
+if __name__ == "__main__":
+	main()
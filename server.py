@@ -1,12 +1,24 @@
 # Database dealing code (shared between interfaces)
 
+from collections import namedtuple, OrderedDict
+import contextlib
+import functools
+import itertools
 import logging
 import os
 import pickle
+import sys
+import threading
+import time
 
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 from psycopg2 import sql
 
+import metrics
+import uno
+
 # All possible settings and its possible values (first one is the default)
 all_settings = {
 	'style': ('short', 'emoji', 'circle', 'heart', 'long',),
@@ -27,120 +39,699 @@ all_configs = {
 	# 'number_starting_cards': 7,
 }
 
-conn, cur = None, None
+# Plays are stored one by one, and the whole game only every this many plays
+SNAPSHOT_INTERVAL = 20
+
+# Constraints added by the updates in sql-updates, by table, checked on startup
+required_constraints = {
+	'uno_joins': ('uno_joins_user_id_key', 'uno_joins_room_id_player_number_key', 'uno_joins_room_id_fkey',),
+	'uno_moves': ('uno_moves_room_id_play_number_key', 'uno_moves_room_id_fkey',),
+}
+
+# Everything about the room of a user that handlers need, from one query.
+# Users are (player number, user id) in seat order, and settings are by user id.
+RoomContext = namedtuple('RoomContext', ['room_id', 'user_id', 'player_number', 'game', 'configs', 'users', 'settings'])
+
+# Connections kept open at most, and seconds a connection can sit unused
+# before it's checked to still work when taken again
+POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', 4))
+HEALTH_CHECK_INTERVAL = 30
+CONNECT_ATTEMPTS = 3
+
+# Rooms kept decoded in memory at most, by number and by approximate size
+ROOM_CACHE_SIZE = int(os.environ.get('ROOM_CACHE_SIZE', 1000))
+ROOM_CACHE_MEMORY = int(os.environ.get('ROOM_CACHE_MEMORY_MB', 64)) * 1024 * 1024
+
+# Game, configs and users of a room as in the database, with the room's version
+# there. The cache version changes every time the room is stored in the cache.
+CachedRoom = namedtuple('CachedRoom', ['cache_version', 'version', 'game', 'configs', 'users', 'size'])
+
+# Room as a transaction left it, to be cached when it commits. The base version
+# is the cache version it came from, and the read epoch is set when it was read
+# from the database instead.
+RoomWrite = namedtuple('RoomWrite', ['base_version', 'room', 'read_epoch', 'written'])
+
+# Times a handler is run when rooms it writes were changed by someone else meanwhile
+CONFLICT_ATTEMPTS = 3
+
+# Seconds users' settings are kept in memory, and how many users at most
+SETTINGS_CACHE_TTL = 300
+SETTINGS_CACHE_SIZE = 10000
+
+pool, pool_slots = None, None
+pool_lock = threading.Lock()
+last_used = {}
+
+# Connection and cursor of the transaction of each thread
+local = threading.local()
+
+class TimedCursor(psycopg2.extensions.cursor):
+
+	# Queries are timed as the database phase of the handler making them
+	def execute(self, query, vars=None):
+		with metrics.phase('db'):
+			return super().execute(query, vars)
+
+## Connections
+
+def get_pool():
+	# Made on first use, so importing this doesn't connect
+	global pool, pool_slots
+	with pool_lock:
+		if pool is None:
+			pool = psycopg2.pool.ThreadedConnectionPool(0, POOL_SIZE, os.environ.get('DATABASE_URL'))
+			pool_slots = threading.BoundedSemaphore(POOL_SIZE)
+	return pool
+
+def get_connection():
+
+	get_pool()
+
+	# Waits for a free connection, since the pool itself fails when there's none
+	pool_slots.acquire()
+
+	try:
+		for attempt in range(CONNECT_ATTEMPTS):
+			conn = pool.getconn()
+			if check_connection(conn):
+				return conn
+
+			logging.warning('Dropping broken database connection')
+			put_connection(conn, close=True)
+
+		raise psycopg2.OperationalError('Could not get a working database connection')
+
+	except BaseException:
+		pool_slots.release()
+		raise
+
+def check_connection(conn):
+
+	if conn.closed:
+		return False
+
+	if time.monotonic() - last_used.get(conn, 0) < HEALTH_CHECK_INTERVAL:
+		return True
+
+	try:
+		with conn.cursor() as check_cur:
+			check_cur.execute("select 1;")
+		conn.rollback()
+		return True
+	except psycopg2.Error:
+		return False
+
+def put_connection(conn, close=False):
+	last_used.pop(conn, None)
+	if not close:
+		last_used[conn] = time.monotonic()
+	pool.putconn(conn, close=close)
+
+def release_connection(conn):
+	# Connections broken during the transaction are closed, and new ones made later
+	try:
+		put_connection(conn, close=bool(conn.closed))
+	finally:
+		pool_slots.release()
+
+@contextlib.contextmanager
+def transaction():
+
+	# Commits at the end, or rolls back if anything goes wrong. Transactions
+	# inside another one in the same thread are part of the outer one.
+	if getattr(local, 'conn', None) is not None:
+		yield local.cur
+		return
+
+	conn = get_connection()
+	local.conn, local.cur = conn, conn.cursor(cursor_factory=TimedCursor)
+	local.room_writes, local.room_versions, local.after_commit = {}, {}, []
+
+	try:
+		yield local.cur
+		conn.commit()
+		apply_room_writes()
+
+	except BaseException:
+		try:
+			conn.rollback()
+		except psycopg2.Error:
+			pass
+		raise
+
+	finally:
+		callbacks = local.after_commit
+		local.conn, local.cur, local.room_writes, local.room_versions, local.after_commit = None, None, None, None, None
+		release_connection(conn)
+
+	# Only reached when committed, and with the connection already given back
+	for callback in callbacks:
+		callback()
+
+def in_transaction(function):
+
+	# For handlers, which then run whole in one transaction, and again from
+	# the start if a room they wrote was changed by someone else meanwhile
+	@functools.wraps(function)
+	def function_in_transaction(*args, **kwargs):
+		if getattr(local, 'conn', None) is not None:
+			return function(*args, **kwargs)
+
+		for attempt in range(CONFLICT_ATTEMPTS):
+			try:
+				with transaction():
+					return function(*args, **kwargs)
+
+			except RoomConflict as e:
+				metrics.increment('uno_room_conflicts_total')
+				if attempt == CONFLICT_ATTEMPTS - 1:
+					raise
+				logging.info('Running %s again: %s', function.__name__, e)
+
+	return function_in_transaction
+
+def after_commit(callback):
+	# Things that can't be undone, like sending messages, wait for the commit
+	if getattr(local, 'conn', None) is not None:
+		local.after_commit.append(callback)
+	else:
+		callback()
+
+class RoomConflict(Exception):
+	pass
+
+def note_room_version(room_id, version):
+	# Writes expect rooms to still be as they were first read in the transaction
+	local.room_versions.setdefault(room_id, version)
+
+def get_room_version(room_id):
+
+	version = local.room_versions.get(room_id)
+	if version is not None:
+		return version
+
+	# Written without being read first
+	cur = get_cursor()
+	cur.execute("select version from uno_rooms where id=%s limit 1;", (room_id,))
+	result = cur.fetchone()
+	version = local.room_versions[room_id] = result[0] if result else 0
+	return version
+
+def check_room_version(room_id, version):
+
+	# The last write only changes a row if the room was still at that version
+	if get_cursor().rowcount == 0:
+		drop_cached_room(room_id)
+		raise RoomConflict('Room ' + str(room_id) + ' was changed after version ' + str(version))
+
+	local.room_versions[room_id] = version + 1
+	return version + 1
+
+def bump_room_version(room_id):
+
+	# Joins and seats are part of the room, so writing them changes its version too
+	version = get_room_version(room_id)
+	get_cursor().execute("update uno_rooms set version=version+1 where id=%s and version=%s;", (room_id, version,))
+	return check_room_version(room_id, version)
+
+def get_cursor():
+	cur = getattr(local, 'cur', None)
+	if cur is None:
+		raise RuntimeError('Database used outside of a transaction')
+	return cur
+
+## Room cache
+
+# Rooms are read from the cache, and written to it as they're written to the
+# database. Writes only reach the cache when their transaction commits, and
+# drop the room instead if another transaction changed it in the meantime.
+# Rooms changed by other processes are found out by their version in the
+# database, checked when first used in a transaction, and are then read again.
+
+room_cache = OrderedDict()
+room_cache_bytes = 0
+user_rooms = {}
+cache_lock = threading.Lock()
+
+# Goes up with every commit that writes rooms, and is kept for each room as
+# when it was last written, so rooms read from the database before that aren't
+# cached over newer ones. Rooms written longest ago are forgotten, and count
+# as written when the last forgotten one was.
+cache_epoch = 0
+cache_versions = itertools.count(1)
+room_write_epochs = OrderedDict()
+forgotten_write_epoch = 0
+
+def get_cached_room(room_id):
+
+	# Rooms written in this transaction aren't in the cache yet
+	writes = getattr(local, 'room_writes', None)
+	if writes and room_id in writes:
+		room = writes[room_id].room
+
+	else:
+		with cache_lock:
+			room = room_cache.get(room_id)
+			if room:
+				room_cache.move_to_end(room_id)
+
+	metrics.increment('uno_room_cache_total', labels={'result': 'hit' if room else 'miss'})
+	return room
+
+def get_current_cached_room(room_id):
+
+	# The version is checked once per transaction, as other processes may
+	# have changed the room since it was cached
+	room = get_cached_room(room_id)
+	if not room or room_id in local.room_writes or local.room_versions.get(room_id) == room.version:
+		return room
+
+	cur = get_cursor()
+	cur.execute("select version from uno_rooms where id=%s;", (room_id,))
+	result = cur.fetchone()
+
+	if result and result[0] == room.version:
+		return room
+
+	drop_cached_room(room_id)
+	return None
+
+def get_cached_user_room_id(user_id):
+	with cache_lock:
+		return user_rooms.get(user_id)
+
+def fill_room(room_id, room, epoch):
+
+	# Rooms read from the database are cached with the transaction's writes,
+	# unless someone else wrote them since reading
+	writes = local.room_writes
+	if room_id in writes:
+		write = writes[room_id]
+		writes[room_id] = write._replace(room=room, read_epoch=epoch if write.read_epoch is None else write.read_epoch)
+		return
+
+	with cache_lock:
+		cached_room = room_cache.get(room_id)
+
+	writes[room_id] = RoomWrite(cached_room.cache_version if cached_room else None, room, epoch, False)
+
+def write_room(room_id, change=None):
+
+	# The change makes the new room out of the old one, or without it the
+	# room is dropped and read again from the database next time
+	writes = local.room_writes
+	if room_id in writes:
+		write = writes[room_id]
+	else:
+		with cache_lock:
+			cached_room = room_cache.get(room_id)
+		write = RoomWrite(cached_room.cache_version if cached_room else None, cached_room, None, True)
+
+	writes[room_id] = write._replace(room=change(write.room) if write.room and change else None, written=True)
+
+def apply_room_writes():
+
+	global cache_epoch
+
+	writes = local.room_writes
+	if not writes:
+		return
+
+	with cache_lock:
+		cache_epoch += 1
+
+		for room_id, write in writes.items():
+			cached_room = room_cache.get(room_id)
+			if (write.room and (cached_room.cache_version if cached_room else None) == write.base_version
+					and (write.read_epoch is None or get_room_write_epoch(room_id) <= write.read_epoch)):
+				store_room(room_id, write.room._replace(cache_version=next(cache_versions)))
+			elif cached_room and write.written:
+				remove_room(room_id)
+
+			if write.written:
+				note_room_write(room_id)
+
+	writes.clear()
+
+def get_room_write_epoch(room_id):
+	# Must have the cache lock
+	return room_write_epochs.get(room_id, forgotten_write_epoch)
+
+def note_room_write(room_id):
+
+	# Must have the cache lock
+	global forgotten_write_epoch
+
+	room_write_epochs[room_id] = cache_epoch
+	room_write_epochs.move_to_end(room_id)
+
+	while len(room_write_epochs) > ROOM_CACHE_SIZE:
+		forgotten_write_epoch = room_write_epochs.popitem(last=False)[1]
+
+def store_room(room_id, room):
+
+	# Must have the cache lock
+	global room_cache_bytes
+
+	if room_id in room_cache:
+		remove_room(room_id)
+
+	room_cache[room_id] = room
+	room_cache_bytes += room.size
+	for player_number, user_id in room.users:
+		user_rooms[user_id] = room_id
+
+	# Least recently used rooms go first
+	while len(room_cache) > ROOM_CACHE_SIZE or room_cache_bytes > ROOM_CACHE_MEMORY:
+		remove_room(next(iter(room_cache)))
+
+def remove_room(room_id):
+
+	# Must have the cache lock
+	global room_cache_bytes
+
+	room = room_cache.pop(room_id)
+	room_cache_bytes -= room.size
+	for player_number, user_id in room.users:
+		if user_rooms.get(user_id) == room_id:
+			del user_rooms[user_id]
+
+def make_cached_room(version, game, configs, users):
+	return CachedRoom(None, version, game, configs, users, get_room_size(game, configs, users))
+
+def drop_cached_room(room_id):
+	with cache_lock:
+		if room_id in room_cache:
+			remove_room(room_id)
+
+def copy_cached_room(room):
+	# Rooms are copied in and out of the cache, so handlers can change theirs
+	return room._replace(game=room.game.clone() if room.game else None, configs=dict(room.configs), users=list(room.users))
+
+def get_room_size(game, configs, users):
+
+	# Near enough to bound the memory taken, counting containers one level deep
+	def get_size(value):
+		size = sys.getsizeof(value)
+		if isinstance(value, (list, tuple)):
+			size += sum(sys.getsizeof(item) for item in value)
+		return size
+
+	size = get_size(configs) + get_size(users)
+	if game:
+		size += sys.getsizeof(game) + sum(get_size(value) for value in vars(game).values())
+	return size
+
+def sort_users(users):
+	# Like the database does, players without a number go last
+	return sorted(users, key=lambda user: (user[0] is None, user[0] or 0, user[1]))
+
+## Settings cache
+
+# Settings barely ever change, so they're kept for a while. Users that change
+# theirs are dropped from the cache once the change is committed.
 
-def main():
+settings_cache = OrderedDict()
+settings_lock = threading.Lock()
 
-	# Environment vars
-	DATABASE_URL = os.environ.get('DATABASE_URL')
+# Goes up every time a user's settings are dropped, kept for each user as when
+# theirs were last dropped, so settings read before that aren't cached
+settings_epoch = 0
+settings_dropped = {}
 
-	# Enable logging
-	logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
-	logger = logging.getLogger(__name__)
+def get_cached_settings(user_ids):
 
-	# Database setup
-	global conn, cur
-	conn = psycopg2.connect(DATABASE_URL)
-	cur = conn.cursor()
+	now = time.monotonic()
+	settings = {}
+
+	with settings_lock:
+		for user_id in user_ids:
+			cached = settings_cache.get(user_id)
+			if cached and cached[0] > now:
+				settings_cache.move_to_end(user_id)
+				settings[user_id] = cached[1]
+
+	metrics.increment('uno_settings_cache_total', len(settings), labels={'result': 'hit'})
+	metrics.increment('uno_settings_cache_total', len(user_ids) - len(settings), labels={'result': 'miss'})
+	return settings
+
+def cache_settings(settings, epoch):
+
+	# Settings read from the database, cached unless dropped since reading
+	expires = time.monotonic() + SETTINGS_CACHE_TTL
+
+	with settings_lock:
+		for user_id, user_settings in settings.items():
+			if settings_dropped.get(user_id, 0) > epoch:
+				continue
+
+			settings_cache[user_id] = (expires, dict(user_settings))
+			settings_cache.move_to_end(user_id)
+
+		while len(settings_cache) > SETTINGS_CACHE_SIZE:
+			settings_cache.popitem(last=False)
+
+def invalidate_user_settings(user_id):
+	global settings_epoch
+	with settings_lock:
+		settings_epoch += 1
+		settings_dropped[user_id] = settings_epoch
+		settings_cache.pop(user_id, None)
 
 ## Database functions
 
 def get_user_settings(user_id):
+	return get_users_settings([user_id])[user_id]
+
+def get_users_settings(user_ids):
+
+	user_ids = list(user_ids)
+	settings = get_cached_settings(user_ids)
+	missing_user_ids = [user_id for user_id in user_ids if user_id not in settings]
+
+	if missing_user_ids:
+		cur = get_cursor()
+		epoch = settings_epoch
+
+		all_settings_list = list(all_settings)
+
+		cur.execute(
+			sql.SQL("select user_id, {fields} from uno_users where user_id = any(%s);")
+				.format(
+					fields=sql.SQL(',').join(sql.Identifier(n) for n in all_settings_list)
+				),
+			(missing_user_ids,)
+		)
+
+		missing_settings = make_users_settings(missing_user_ids, cur.fetchall())
+		cache_settings(missing_settings, epoch)
+		settings.update(missing_settings)
+
+	# Copies, so the cached ones stay as they are
+	return {user_id: dict(user_settings) for user_id, user_settings in settings.items()}
+
+def make_users_settings(user_ids, rows):
+	# Users that never changed their settings have no row
+	settings = {user_id: {k: v[0] for k, v in all_settings.items()} for user_id in user_ids}
+	for row in rows or ():
+		settings[row[0]] = dict(zip(all_settings, row[1:]))
+	return settings
+
+def get_room_configs(room_id):
+	room = get_room(room_id)
+	return room.configs if room else None
+
+def get_current_room(user_id):
+	cur = get_cursor()
+	cur.execute("select room_id from uno_joins where user_id=%s limit 1;", (user_id,))
+	result = cur.fetchone()
+
+	if result:
+		return result[0]
 
-	all_settings_list = list(all_settings)
+	return None
+
+def select_users_info_in_room(room_id):
+	room = get_room(room_id)
+	return room.users if room else []
+
+def select_users_ids_in_room(room_id):
+	return sorted(user_id for player_number, user_id in select_users_info_in_room(room_id))
+
+def select_game(room_id):
+	room = get_room(room_id)
+	return room.game if room else None
+
+def get_room(room_id):
+
+	room = get_current_cached_room(room_id)
+	if room:
+		note_room_version(room_id, room.version)
+		return copy_cached_room(room)
+
+	cur = get_cursor()
+	epoch = cache_epoch
 
 	cur.execute(
-		sql.SQL("select {fields} from uno_users where user_id=%s limit 1;")
+		sql.SQL("select {room_fields} from uno_rooms r where r.id=%s limit 1;")
 			.format(
-				fields=sql.SQL(',').join(sql.Identifier(n) for n in all_settings_list)
+				room_fields=get_room_fields()
 			),
-		(user_id,)
+		(room_id,)
 	)
 
 	result = cur.fetchone()
 
 	if not result:
-		return {k: v[0] for k, v in all_settings.items()} # default values for all settings
-	else:
-		settings = dict(zip(all_settings_list, result))
+		return None
 
-		return settings
+	room = make_room(room_id, result)
+	fill_room(room_id, copy_cached_room(room), epoch)
+	note_room_version(room_id, room.version)
 
-def get_room_configs(room_id):
+	return room
+
+def get_room_fields():
+	# Version, game, configs, then users and plays to replay as JSON arrays of the room's rows
+	return (
+		sql.SQL("r.version, r.game_pickle, {configs}, "
+			"(select json_agg(json_build_array(ju.player_number, ju.user_id) order by ju.player_number, ju.user_id) "
+				"from uno_joins ju where ju.room_id=r.id), "
+			"(select json_agg(m.play order by m.play_number) "
+				"from uno_moves m where m.room_id=r.id and m.play_number>r.snapshot_play_number)")
+			.format(
+				configs=sql.SQL(',').join(sql.Identifier('r', n) for n in all_configs)
+			)
+	)
+
+def make_room(room_id, row):
+	version, game_pickle = row[:2]
+	configs = dict(zip(all_configs, row[2:2 + len(all_configs)]))
+	users_rows, plays = row[2 + len(all_configs):]
+
+	users = [(user_row[0], user_row[1],) for user_row in users_rows or ()]
+
+	return make_cached_room(version, make_game(room_id, version, game_pickle, plays or ()), configs, users)
+
+def make_game(room_id, version, game_pickle, plays):
+
+	if not game_pickle:
+		return None
+
+	with metrics.phase('engine'):
+		game = load_game(room_id, version, bytes(game_pickle))
 
-	all_configs_list = list(all_configs)
+		if not game:
+			return None
+
+		for play in plays:
+			play_result = game.play(game.current_player, uno.decode_play(play))
+
+			if not play_result.success:  # this is never supposed to happen!
+				raise RuntimeError('Stored play could not be replayed in room ' + str(room_id) + ': ' + str(play_result.fail_reason))
+
+	return game
+
+def load_room_context(user_id):
+
+	# Rooms in the cache only need their users' settings
+	room_id = get_cached_user_room_id(user_id)
+	room = get_current_cached_room(room_id)
+
+	if room:
+		player_numbers = {for_user_id: for_player_number for for_player_number, for_user_id in room.users}
+
+		if user_id in player_numbers:
+			note_room_version(room_id, room.version)
+			room = copy_cached_room(room)
+			return RoomContext(room_id, user_id, player_numbers[user_id], room.game, room.configs, room.users,
+				get_users_settings(player_numbers))
+
+	cur = get_cursor()
+	epoch = cache_epoch
+	settings_read_epoch = settings_epoch
 
 	cur.execute(
-		sql.SQL("select {fields} from uno_rooms where id=%s limit 1;")
+		sql.SQL("select j.room_id, j.player_number, {room_fields}, "
+			"(select json_agg(json_build_array(u.user_id, {settings})) "
+				"from uno_joins ju join uno_users u on u.user_id=ju.user_id where ju.room_id=r.id) "
+			"from uno_joins j join uno_rooms r on r.id=j.room_id where j.user_id=%s limit 1;")
 			.format(
-				fields=sql.SQL(',').join(sql.Identifier(n) for n in all_configs_list)
+				room_fields=get_room_fields(),
+				settings=sql.SQL(',').join(sql.Identifier('u', n) for n in all_settings)
 			),
-		(room_id,)
+		(user_id,)
 	)
 
 	result = cur.fetchone()
 
-	if not result:  # this is never supposed to happen!
-		# return {k: v[0] for k, v in all_configs.items()} # default values for all configs
+	if not result:
 		return None
-	else:
-		configs = dict(zip(all_configs_list, result))
 
-		return configs
+	room_id, player_number = result[:2]
+	room = make_room(room_id, result[2:-1])
+	fill_room(room_id, copy_cached_room(room), epoch)
+	note_room_version(room_id, room.version)
 
-def get_current_room(user_id):
-	cur.execute("select room_id from uno_joins where user_id=%s limit 1;", (user_id,))
-	result = cur.fetchone()
+	settings = make_users_settings([for_user_id for for_player_number, for_user_id in room.users], result[-1])
+	cache_settings(settings, settings_read_epoch)
 
-	if result:
-		return result[0]
+	return RoomContext(room_id, user_id, player_number, room.game, room.configs, room.users, settings)
 
-	return None
+def get_room_user_id(room, player_number):
+	return next((for_user_id for for_player_number, for_user_id in room.users if for_player_number == player_number), None)
 
-def select_users_info_in_room(room_id):
-	cur.execute("select player_number, user_id from uno_joins where room_id=%s order by player_number, user_id;", (room_id,))
-	return [(row[0], row[1],) for row in cur]
+def load_game(room_id, version, data):
 
-def select_users_ids_in_room(room_id):
-	cur.execute("select user_id from uno_joins where room_id=%s order by user_id;", (room_id,))
-	return [row[0] for row in cur]
+	if data.startswith(uno.GAME_BYTES_MAGIC):
+		return uno.Game.from_bytes(data)
 
-def select_player_number(room_id, user_id):
-	cur.execute("select player_number from uno_joins where room_id=%s and user_id=%s limit 1;", (room_id, user_id))
-	return cur.fetchone()[0]
+	# Games stored as pickles, before the byte format existed or by an older
+	# process still running, are stored again as bytes in the same transaction
+	game = pickle.loads(data)
+	get_cursor().execute("update uno_rooms set game_pickle=%s where id=%s and version=%s;",
+		(game.to_bytes() if game else None, room_id, version,))
+	return game
 
-def select_user_id_from_player_number(room_id, player_number):
-	cur.execute("select user_id from uno_joins where room_id=%s and player_number=%s limit 1;", (room_id, player_number))
-	return cur.fetchone()[0]
+def count_active_games():
+	# Read from the metrics thread, so in a transaction of its own
+	with transaction() as cur:
+		cur.execute("select count(*) from uno_rooms where game_pickle is not null;")
+		return cur.fetchone()[0]
 
-def select_game(room_id):
-	cur.execute("select game_pickle from uno_rooms where id=%s limit 1;", (room_id,))
-	result = cur.fetchone()[0]
+def get_missing_constraints():
+	# Runs on its own, before any handler
+	with transaction() as cur:
+		cur.execute("select c.relname, con.conname from pg_constraint con "
+			"join pg_class c on c.oid = con.conrelid where c.relname = any(%s);", (list(required_constraints),))
+		existing = set(cur.fetchall())
 
-	if result:
-		return pickle.loads(result)
-	else:
-		return None
+	return [table + '.' + name for table, names in required_constraints.items() for name in names
+		if (table, name) not in existing]
+
+def lock_room(room_id):
 
-def check_room_empty(room_id):
-	cur.execute("select room_id from uno_joins where room_id=%s limit 1;", (room_id,))
+	# Writes to the room by others wait until this transaction ends, and the
+	# room is read from the database if the cached one is older. Returns
+	# whether the room exists.
+	cur = get_cursor()
+	cur.execute("select version from uno_rooms where id=%s for update;", (room_id,))
 	result = cur.fetchone()
 
-	if result:
+	if not result:
 		return False
 
-	return True
-
-def check_room_exists(room_id):
-	cur.execute("select id from uno_rooms where id=%s limit 1;", (room_id,))
-	result = cur.fetchone()
+	with cache_lock:
+		room = room_cache.get(room_id)
 
-	if result:
-		return True
+	if room and room.version != result[0]:
+		drop_cached_room(room_id)
 
-	return False
+	note_room_version(room_id, result[0])
+	return True
 
 def insert_room():
+	cur = get_cursor()
 	cur.execute("insert into uno_rooms default values returning id;")
 	room_id = cur.fetchone()[0]
 	# conn.commit()
@@ -148,19 +739,67 @@ def insert_room():
 	return room_id
 
 def insert_user_to_room(room_id, user_id):
-	cur.execute("insert into uno_joins (room_id, user_id) values (%s, %s);", (room_id, user_id,))
+	insert_users_to_room(room_id, [user_id])
+
+def insert_users_to_room(room_id, user_ids):
+	cur = get_cursor()
+	version = bump_room_version(room_id)
+	cur.execute("insert into uno_joins (room_id, user_id) select %s, unnest(%s::integer[]);", (room_id, list(user_ids),))
+	write_room(room_id, lambda room: make_cached_room(version, room.game, room.configs,
+		sort_users(room.users + [(None, user_id) for user_id in user_ids])))
+	# conn.commit()
+
+def insert_play(room_id, game, play):
+	cur = get_cursor()
+	version = get_room_version(room_id)
+
+	# Game must be the one after the play was made. The play is only stored if
+	# the room's version is still the one the game was read at.
+	cur.execute("with room as (update uno_rooms set version=version+1 where id=%s and version=%s returning id) "
+		"insert into uno_moves (room_id, play_number, play) select id, %s, %s from room;",
+		(room_id, version, game.current_play_number, uno.encode_play(play),))
+	version = check_room_version(room_id, version)
+
+	if game.current_play_number % SNAPSHOT_INTERVAL == 0:
+		update_game(room_id, game)
+	else:
+		write_room(room_id, lambda room: make_cached_room(version, game.clone(), room.configs, room.users))
 	# conn.commit()
 
 def update_game(room_id, game):
-	cur.execute("update uno_rooms set game_pickle=%s where id=%s;", (pickle.dumps(game), room_id,))
+	cur = get_cursor()
+	version = get_room_version(room_id)
+	snapshot_play_number = game.current_play_number if game else 0
+
+	cur.execute("update uno_rooms set game_pickle=%s, snapshot_play_number=%s, version=version+1 where id=%s and version=%s;",
+		(game.to_bytes() if game else None, snapshot_play_number, room_id, version,))
+	version = check_room_version(room_id, version)
+
+	# Plays after the stored game are from a game that is over
+	cur.execute("delete from uno_moves where room_id=%s and play_number>%s;", (room_id, snapshot_play_number,))
+
+	write_room(room_id, lambda room: make_cached_room(version, game.clone() if game else None, room.configs, room.users))
 	# conn.commit()
 
 def update_player_number(room_id, user_id, player_number):
-	cur.execute("update uno_joins set player_number=%s where room_id=%s and user_id=%s;", (player_number, room_id, user_id,))
+	update_player_numbers(room_id, {user_id: player_number})
+
+def update_player_numbers(room_id, player_numbers):
+	# Player numbers by user id, all set at once
+	cur = get_cursor()
+	version = bump_room_version(room_id)
+	cur.execute("update uno_joins j set player_number=v.player_number "
+		"from unnest(%s::integer[], %s::integer[]) as v(user_id, player_number) "
+		"where j.room_id=%s and j.user_id=v.user_id;",
+		(list(player_numbers), list(player_numbers.values()), room_id,))
+	write_room(room_id, lambda room: make_cached_room(version, room.game, room.configs,
+		sort_users([(player_numbers.get(for_user_id, for_player_number), for_user_id) for for_player_number, for_user_id in room.users])))
 	# conn.commit()
 
 def update_user_settings(user_id, setting, value):
 
+	cur = get_cursor()
+
 	cur.execute(
 		sql.SQL("insert into uno_users (user_id, {settings}) values (%s, %s) "
 			"on conflict (user_id) do update set {settings} = excluded.{settings};")
@@ -173,24 +812,41 @@ def update_user_settings(user_id, setting, value):
 
 def update_room_config(room_id, config, value):
 
+	cur = get_cursor()
+	version = get_room_version(room_id)
+
 	cur.execute(
-		sql.SQL("update uno_rooms set {configs}=%s where id=%s;")
+		sql.SQL("update uno_rooms set {configs}=%s, version=version+1 where id=%s and version=%s;")
 			.format(
 				configs=sql.Identifier(config)
 			),
-		(value, room_id,)
+		(value, room_id, version,)
 	)
+	version = check_room_version(room_id, version)
+
+	write_room(room_id, lambda room: make_cached_room(version, room.game, dict(room.configs, **{config: value}), room.users))
 	# conn.commit()
 
 def delete_user_from_room(user_id):
-	cur.execute("delete from uno_joins where user_id=%s;", (user_id,))
+	delete_users_from_room([user_id])
+
+def delete_users_from_room(user_ids):
+	cur = get_cursor()
+	cur.execute("delete from uno_joins where user_id = any(%s) returning room_id, user_id;", (list(user_ids),))
+
+	deleted = {}
+	for room_id, user_id in cur.fetchall():
+		deleted.setdefault(room_id, set()).add(user_id)
+
+	for room_id, room_user_ids in deleted.items():
+		version = bump_room_version(room_id)
+		write_room(room_id, lambda room: make_cached_room(version, room.game, room.configs,
+			[(for_player_number, for_user_id) for for_player_number, for_user_id in room.users if for_user_id not in room_user_ids]))
 	# conn.commit()
 
 def delete_room(room_id):
-	cur.execute("delete from uno_rooms where id=%s;", (room_id,))
+	cur = get_cursor()
+	# Along with whoever is still in it
+	cur.execute("with joins as (delete from uno_joins where room_id=%s) delete from uno_rooms where id=%s;", (room_id, room_id,))
+	write_room(room_id)
 	# conn.commit()
-
-def commit():
-	conn.commit()
-
-main()
\ No newline at end of file
@@ -0,0 +1,16 @@
+begin;
+
+alter table uno_rooms
+	add column snapshot_play_number
+		integer not null default 0;
+
+create table uno_moves (
+	id serial primary key,
+	room_id integer not null
+		references uno_rooms (id) on delete cascade,
+	play_number integer not null,
+	play smallint not null,
+	unique (room_id, play_number)
+);
+
+commit;
@@ -0,0 +1,48 @@
+begin;
+
+-- Users in more than one room stay only in the one joined last, and games
+-- they had a seat in are ended, as they can't go on without them
+with left_joins as (
+	delete from uno_joins a
+		using uno_joins b
+		where a.user_id = b.user_id and a.id < b.id
+		returning a.room_id, a.player_number
+), ended as (
+	update uno_rooms set game_pickle = null, snapshot_play_number = 0
+		where id in (select room_id from left_joins where player_number is not null)
+		returning id
+)
+delete from uno_moves
+	where room_id in (select id from ended);
+
+delete from uno_joins
+	where room_id is null or user_id is null
+		or room_id not in (select id from uno_rooms);
+
+-- Players sharing a number in a room lose it, and the room's game is ended
+-- so it has to begin again
+with unseated as (
+	update uno_joins a set player_number = null
+		from uno_joins b
+		where a.room_id = b.room_id and a.player_number = b.player_number and a.id <> b.id
+		returning a.room_id
+), ended as (
+	update uno_rooms set game_pickle = null, snapshot_play_number = 0
+		where id in (select room_id from unseated)
+		returning id
+)
+delete from uno_moves
+	where room_id in (select id from ended);
+
+-- The constraints' indexes are also the ones joins are looked up by
+alter table uno_joins
+	alter column room_id set not null,
+	alter column user_id set not null,
+	add constraint uno_joins_user_id_key
+		unique (user_id),
+	add constraint uno_joins_room_id_player_number_key
+		unique (room_id, player_number) deferrable initially deferred,
+	add constraint uno_joins_room_id_fkey
+		foreign key (room_id) references uno_rooms (id) on delete cascade;
+
+commit;
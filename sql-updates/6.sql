@@ -0,0 +1,9 @@
+begin;
+
+-- Goes up with every change to the room's game, configs, joins or seats,
+-- which only happen if the version is still the one the room was read at
+alter table uno_rooms
+	add column version
+		integer not null default 0;
+
+commit;
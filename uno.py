@@ -1,11 +1,16 @@
+import bisect
 from collections import namedtuple
 import random
+import struct
 
 NO_COLOR, COLOR_BLUE, COLOR_GREEN, COLOR_RED, COLOR_YELLOW = range(5)
 COLORS = [COLOR_BLUE, COLOR_GREEN, COLOR_RED, COLOR_YELLOW]
 
 KIND_REVERSE, KIND_SKIP, KIND_DRAW_2, KIND_DRAW_4, KIND_WILD = range(10, 15)
 
+NUM_COLORS = COLOR_YELLOW + 1
+NUM_KINDS = KIND_WILD + 1
+
 ACTION_PLAY, ACTION_DRAW, ACTION_PASS, ACTION_CALL_BLUFF = range(4)
 
 class Game():
@@ -25,110 +30,450 @@ class Game():
 		# init
 		self.reset()
 
+	def apply_configs(self, configs):
+		# Configs as stored for rooms, all values are strings
+		self.draw_4_on_draw_4 = (configs.get('draw_4_on_draw_4') == 'true')
+		self.draw_2_on_draw_4 = (configs.get('draw_2_on_draw_4'))
+		self.disable_call_bluff = (configs.get('disable_call_bluff') == 'true')
+		self.allow_play_non_drawn_cards = (configs.get('allow_play_non_drawn_cards') == 'true')
+		self.allow_pass_without_draw = (configs.get('allow_pass_without_draw') == 'true')
+		self.draw_pass_behavior = (configs.get('draw_pass_behavior'))
+
 	def reset(self):
 
 		self.num_players = 0
 		self.winner = None
-		self.current_card = None
+		self.current_face = None
 		self.current_kind = None
 		self.current_color = None
 		self.current_player = 0
 		self.previous_player = None
 		self.direction = 1
-		self.drawn_card = None
+		self.drawn_face = None
 		self.draw_amount = 0
 		self.can_call_bluff = False
 		self.previous_bluffed = None
-		self.draw_pile = []
-		self.player_cards = []
-		self.discard_pile = []
+		self.pile = bytearray(DECK_SIZE)
+		self.draw_start = 0
+		self.draw_count = 0
+		self.discard_count = 0
+		self.player_hands = []
+		self.sorted_hands = []
+		self.hand_color_counts = []
+		self.hand_kind_counts = []
+		self.hand_masks = []
 		self.draw_pile_has_emptied = False
 		self.current_play_number = 0
+		self.seed = None
+		self.num_random_events = 0
+
+	def __getstate__(self):
+		# Sorted hands, hand counters and masks are rebuilt from the face counts when loading
+		state = self.__dict__.copy()
+		del state['sorted_hands']
+		del state['hand_color_counts']
+		del state['hand_kind_counts']
+		del state['hand_masks']
+		return state
+
+	def __setstate__(self, state):
+		# Games stored before card faces existed keep lists of cards
+		if 'player_cards' in state:
+			state = convert_card_list_state(state)
+
+		# Games stored before seeds existed get a new one
+		if 'seed' not in state:
+			state = dict(state, seed=make_seed(), num_random_events=0)
+
+		# Games stored as separate piles have them put together
+		if 'draw_pile' in state:
+			state = dict(state)
+			draw_pile = state.pop('draw_pile')
+			discard_pile = state.pop('discard_pile')
+		else:
+			draw_pile = None
+
+		self.__dict__.update(state)
+
+		if draw_pile is not None:
+			self.set_piles(draw_pile, discard_pile)
+
+		self.make_hand_indexes(len(self.player_hands))
+
+		for player in range(len(self.player_hands)):
+			self.index_hand(player)
+
+	def to_bytes(self):
+
+		flags = (
+			self.can_call_bluff << 0
+			| self.draw_pile_has_emptied << 1
+			| self.draw_4_on_draw_4 << 2
+			| self.disable_call_bluff << 3
+			| self.allow_play_non_drawn_cards << 4
+			| self.allow_pass_without_draw << 5
+			| (self.previous_bluffed is not None) << 6
+			| bool(self.previous_bluffed) << 7
+			| (self.seed is not None) << 8)
+
+		parts = [GAME_BYTES_MAGIC, GAME_BYTES_HEADER.pack(
+			GAME_BYTES_VERSION,
+			self.num_players,
+			self.starting_num_player_cards,
+			encode_optional(self.winner),
+			encode_optional(self.current_face),
+			encode_optional(self.current_color),
+			self.current_player,
+			encode_optional(self.previous_player),
+			self.direction,
+			encode_optional(self.drawn_face),
+			self.draw_amount,
+			flags,
+			encode_optional(index_or_none(DRAW_2_ON_DRAW_4_VALUES, self.draw_2_on_draw_4)),
+			encode_optional(index_or_none(DRAW_PASS_BEHAVIOR_VALUES, self.draw_pass_behavior)),
+			self.current_play_number,
+			self.seed or 0,
+			self.num_random_events)]
+
+		# Hands and piles as their faces, each after its length
+		for faces in self.sorted_hands + [self.draw_pile, self.discard_pile]:
+			parts.append(bytes((len(faces),)))
+			parts.append(faces)
+
+		return b''.join(parts)
+
+	@classmethod
+	def from_bytes(cls, data):
+
+		if data[:len(GAME_BYTES_MAGIC)] != GAME_BYTES_MAGIC:
+			raise ValueError('Not a stored game')
+
+		pos = len(GAME_BYTES_MAGIC)
+
+		version = data[pos]
+		if version != GAME_BYTES_VERSION:
+			raise ValueError('Unknown stored game version ' + str(version))
+
+		(version, num_players, starting_num_player_cards, winner, current_face, current_color, current_player,
+			previous_player, direction, drawn_face, draw_amount, flags, draw_2_on_draw_4, draw_pass_behavior,
+			current_play_number, seed, num_random_events) = GAME_BYTES_HEADER.unpack_from(data, pos)
+		pos += GAME_BYTES_HEADER.size
+
+		face_lists = []
+		for x in range(num_players + 2):
+			length = data[pos]
+			face_lists.append(data[pos+1 : pos+1+length])
+			pos += 1 + length
+
+		current_face = decode_optional(current_face)
+		draw_2_on_draw_4 = decode_optional(draw_2_on_draw_4)
+		draw_pass_behavior = decode_optional(draw_pass_behavior)
+
+		# Everything is set here rather than through __setstate__, and hands
+		# are made straight from their stored faces, which are already sorted
+		game = cls.__new__(cls)
+		game.__dict__.update({
+			'starting_num_player_cards': starting_num_player_cards,
+			'draw_4_on_draw_4': bool(flags & 1 << 2),
+			'draw_2_on_draw_4': DRAW_2_ON_DRAW_4_VALUES[draw_2_on_draw_4] if draw_2_on_draw_4 is not None else None,
+			'disable_call_bluff': bool(flags & 1 << 3),
+			'allow_play_non_drawn_cards': bool(flags & 1 << 4),
+			'allow_pass_without_draw': bool(flags & 1 << 5),
+			'draw_pass_behavior': DRAW_PASS_BEHAVIOR_VALUES[draw_pass_behavior] if draw_pass_behavior is not None else None,
+			'num_players': num_players,
+			'winner': decode_optional(winner),
+			'current_face': current_face,
+			'current_kind': FACE_KINDS[current_face] if current_face is not None else None,
+			'current_color': decode_optional(current_color),
+			'current_player': current_player,
+			'previous_player': decode_optional(previous_player),
+			'direction': direction,
+			'drawn_face': decode_optional(drawn_face),
+			'draw_amount': draw_amount,
+			'can_call_bluff': bool(flags & 1 << 0),
+			'previous_bluffed': bool(flags & 1 << 7) if flags & 1 << 6 else None,
+			'player_hands': [None] * num_players,
+			'draw_pile_has_emptied': bool(flags & 1 << 1),
+			'current_play_number': current_play_number,
+			'seed': seed if flags & 1 << 8 else None,
+			'num_random_events': num_random_events,
+		})
+
+		game.set_piles(face_lists[num_players], face_lists[num_players + 1])
+		game.make_hand_indexes(num_players)
+
+		for player in range(num_players):
+			game.set_hand(player, face_lists[player])
+
+		return game
+
+	## Copies
+
+	# Only the piles and hands are mutable, everything else in a game is
+	# shared between copies.
+
+	def clone(self):
+		game = self.__class__.__new__(self.__class__)
+		game.__dict__.update(copy_game_state(self.__dict__))
+		return game
 
-	def begin(self, num_players):
+	def snapshot(self):
+		return copy_game_state(self.__dict__)
+
+	def restore(self, snapshot):
+		# A snapshot can be restored any number of times
+		self.__dict__.clear()
+		self.__dict__.update(copy_game_state(snapshot))
+
+	def begin(self, num_players, seed=None):
 
 		self.reset()
 
 		self.num_players = num_players
-		
-		# Generate draw pile cards, with only allowed start cards
-		self.draw_pile += list(generate_starting_cards())
-		# Pick starting card
-		self.set_current_card(self.pick_random_card())
+
+		# The seed and the plays made are enough to replay a game
+		self.seed = seed if seed is not None else make_seed()
+
+		# Draw pile is the whole deck, with allowed start cards on top
+		self.pile[:] = DECK_TEMPLATE
+		self.draw_count = DECK_SIZE
+		# Pick starting card, out of the allowed start cards
+		self.set_current_face(self.pick_random_card(len(STARTING_FACES)))
 
 		# Do special effects of starting card
-		self.do_special_effects(self.current_card)
+		self.do_special_effects(self.current_face)
 
-		# Generate rest of draw pile cards (cards not allowed to start with)
-		self.draw_pile += list(generate_non_starting_cards())
 		# Randomize cards
 		self.shuffle_cards()
 
-		# Pick player cards
-		for player in range(num_players):
-			self.player_cards.append(list(self.pick_cards(self.starting_num_player_cards)))
-			self.sort_player_cards(player)
+		# Deal player cards from the top of the draw pile
+		num_cards = self.starting_num_player_cards
+		num_dealt = num_players * num_cards
+		if num_dealt > self.draw_count:
+			raise IndexError('pick from empty draw pile')
 
-	def set_current_card(self, card):
-		self.current_card = card
-		self.current_kind = card.kind
-		self.current_color = card.color
-		self.discard_pile.append(card)
+		dealt = self.get_pile_faces(self.draw_start, num_dealt)
+		self.draw_start = (self.draw_start + num_dealt) % DECK_SIZE
+		self.draw_count -= num_dealt
+
+		self.player_hands = [None] * num_players
+		self.make_hand_indexes(num_players)
+
+		for player in range(num_players):
+			self.set_hand(player, dealt[player*num_cards : (player+1)*num_cards])
+
+	## Card views (the engine itself only deals with faces)
+
+	@property
+	def current_card(self):
+		if self.current_face is None:
+			return None
+		return CARD_FACES[self.current_face]
+
+	@property
+	def drawn_card(self):
+		if self.drawn_face is None:
+			return None
+		return CARD_FACES[self.drawn_face]
+
+	@property
+	def player_cards(self):
+		return [self.get_player_cards(player) for player in range(len(self.player_hands))]
+
+	def get_player_cards(self, player):
+		return [CARD_FACES[face] for face in self.get_player_faces(player)]
+
+	def get_player_faces(self, player):
+
+		faces = self.sorted_hands[player]
+
+		# The card that was just drawn is shown after the rest of the hand
+		if player == self.current_player and self.drawn_face is not None:
+			index = bisect.bisect_left(faces, self.drawn_face)
+			faces = faces[:index] + faces[index+1:]
+			faces.append(self.drawn_face)
+
+		return faces
+
+	def num_player_cards(self, player):
+		return len(self.sorted_hands[player])
+
+	## Hands and piles
+
+	# Hands are kept as an amount of each face, for checking cards, as the
+	# faces in order, for showing them, as amounts of each color and kind,
+	# for knowing what is in them at once, and as a mask of the faces in them,
+	# for matching against playable faces. All are updated in place.
+
+	def add_to_hand(self, player, face):
+		self.player_hands[player][face] += 1
+		bisect.insort(self.sorted_hands[player], face)
+		self.hand_color_counts[player][FACE_COLORS[face]] += 1
+		self.hand_kind_counts[player][FACE_KINDS[face]] += 1
+		self.hand_masks[player] |= 1 << face
+
+	def remove_from_hand(self, player, face):
+		hand = self.player_hands[player]
+		hand[face] -= 1
+		faces = self.sorted_hands[player]
+		del faces[bisect.bisect_left(faces, face)]
+		self.hand_color_counts[player][FACE_COLORS[face]] -= 1
+		self.hand_kind_counts[player][FACE_KINDS[face]] -= 1
+		if not hand[face]:
+			self.hand_masks[player] &= ~(1 << face)
+
+	def clear_hand(self, player):
+		self.set_hand(player, b'')
+
+	def index_hand(self, player):
+		self.set_hand(player, get_counted_faces(self.player_hands[player]))
+
+	def make_hand_indexes(self, num_players):
+		self.sorted_hands = [None] * num_players
+		self.hand_color_counts = [None] * num_players
+		self.hand_kind_counts = [None] * num_players
+		self.hand_masks = [0] * num_players
+
+	def set_hand(self, player, faces):
+
+		self.player_hands[player] = hand = bytearray(NUM_FACES)
+		self.sorted_hands[player] = sorted_faces = bytearray(sorted(faces))
+		self.hand_color_counts[player] = color_counts = bytearray(NUM_COLORS)
+		self.hand_kind_counts[player] = kind_counts = bytearray(NUM_KINDS)
+		mask = 0
+
+		for face in sorted_faces:
+			hand[face] += 1
+			color_counts[FACE_COLORS[face]] += 1
+			kind_counts[FACE_KINDS[face]] += 1
+			mask |= 1 << face
+
+		self.hand_masks[player] = mask
+
+	def hand_summary(self, player):
+		color_counts = self.hand_color_counts[player]
+		return HandSummary(
+			num_cards=len(self.sorted_hands[player]),
+			colors=tuple(color_counts),
+			kinds=tuple(self.hand_kind_counts[player]),
+			wilds=color_counts[NO_COLOR])
+
+	# Both piles share one ring of DECK_SIZE faces. The draw pile starts at
+	# draw_start with its top card, and the discard pile follows it with its
+	# top card last. Cards in hands leave a gap after the discard pile, which
+	# is where discarded cards go, so nothing is ever moved or copied.
+
+	@property
+	def draw_pile(self):
+		# Bottom to top
+		return self.get_pile_faces(self.draw_start, self.draw_count)[::-1]
+
+	@property
+	def discard_pile(self):
+		# Bottom to top
+		return self.get_pile_faces(self.draw_start + self.draw_count, self.discard_count)
+
+	def get_pile_faces(self, start, count):
+		start %= DECK_SIZE
+		end = start + count
+		if end <= DECK_SIZE:
+			return self.pile[start:end]
+		return self.pile[start:] + self.pile[:end - DECK_SIZE]
+
+	def set_piles(self, draw_pile, discard_pile):
+		# From piles given bottom to top
+		self.pile = bytearray(DECK_SIZE)
+		self.draw_start = 0
+		self.draw_count = len(draw_pile)
+		self.discard_count = len(discard_pile)
+		self.pile[:self.draw_count] = draw_pile[::-1]
+		self.pile[self.draw_count : self.draw_count + self.discard_count] = discard_pile
+
+	def set_current_face(self, face):
+		self.current_face = face
+		self.current_kind = FACE_KINDS[face]
+		self.current_color = FACE_COLORS[face]
+		self.pile[(self.draw_start + self.draw_count + self.discard_count) % DECK_SIZE] = face
+		self.discard_count += 1
 
 	def pick_card(self):
-		if len(self.draw_pile) == 0:
+		if self.draw_count == 0:
 
-			if len(self.discard_pile) <= 1:
+			if self.discard_count <= 1:
 				print("You ran out of cards. How's that even possible")
-				pass
+				raise IndexError('pick from empty draw pile')
 
-			self.draw_pile = self.discard_pile[:-1]
-			self.discard_pile = self.discard_pile[-1:]
+			# Cards under the current card become the draw pile right where they are
+			self.draw_count = self.discard_count - 1
+			self.discard_count = 1
 
 			self.shuffle_cards()
 
 			self.draw_pile_has_emptied = True
 
-		return self.draw_pile.pop()
+		face = self.pile[self.draw_start]
+		self.draw_start = (self.draw_start + 1) % DECK_SIZE
+		self.draw_count -= 1
+		return face
 
 	def pick_cards(self, number):
 		for x in range(number):
 			yield self.pick_card()
 
-	def pick_random_card(self):
-		return self.draw_pile.pop(random.randrange(len(self.draw_pile)))
+	def pick_cards_to_hand(self, player, number):
+		for face in self.pick_cards(number):
+			self.add_to_hand(player, face)
 
-	def shuffle_cards(self):
-		random.shuffle(self.draw_pile)
+	def pick_random_card(self, among=None):
+		# Out of the top cards of the draw pile, or all of them
+		pile, start = self.pile, self.draw_start
+		index = (start + self.get_random().randrange(among or self.draw_count)) % DECK_SIZE
+		pile[start], pile[index] = pile[index], pile[start]
+		return self.pick_card()
 
-	def sort_player_cards(self, player):
-		self.player_cards[player].sort(key=lambda card: (card.color, card.kind, ))
+	def shuffle_cards(self):
+		# Same as random.shuffle, on the draw pile part of the ring
+		rng = self.get_random()
+		pile, start = self.pile, self.draw_start
+		for i in reversed(range(1, self.draw_count)):
+			j = rng.randrange(i + 1)
+			a, b = (start + i) % DECK_SIZE, (start + j) % DECK_SIZE
+			pile[a], pile[b] = pile[b], pile[a]
+
+	def get_random(self):
+		# Every random event gets its own generator, made from the seed and the
+		# number of events before it, so only those two numbers are stored
+		rng = random.Random('{}:{}'.format(self.seed, self.num_random_events))
+		self.num_random_events += 1
+		return rng
 
 	def next_player(self):
 		self.previous_player = self.current_player
 		self.current_player = (self.current_player + self.direction) % self.num_players
 
-	def do_special_effects(self, card, new_color=None):
+	def do_special_effects(self, face, new_color=None):
+
+		kind = FACE_KINDS[face]
 
 		# Special card effects
-		if card.kind == KIND_REVERSE:
+		if kind == KIND_REVERSE:
 			self.direction = -self.direction
 
 			# When it's only 2 players, reverse works like skip
 			if self.num_players == 2:
 				self.next_player()
 
-		elif card.kind == KIND_SKIP:
+		elif kind == KIND_SKIP:
 			self.next_player()
 
-		elif card.kind == KIND_DRAW_2:
+		elif kind == KIND_DRAW_2:
 			self.draw_amount += 2
 
-		elif card.kind == KIND_DRAW_4:
+		elif kind == KIND_DRAW_4:
 			self.draw_amount += 4
 			self.current_color = new_color
 
-		elif card.kind == KIND_WILD:
+		elif kind == KIND_WILD:
 			self.current_color = new_color
 
 	def play(self, player, play):
@@ -138,71 +483,80 @@ class Game():
 
 		self.draw_pile_has_emptied = False
 
-		for intent in self.get_play_intents(self.current_player):
-			if intent.action == play.action and intent.card == play.card:
-				
-				if intent.can_play:
-					if play.action == ACTION_PLAY:
-						return self.play_card(play.card, play.new_color)
-					elif play.action == ACTION_DRAW:
-						return self.play_draw()
-					elif play.action == ACTION_PASS:
-						return self.play_pass()
-					elif play.action == ACTION_CALL_BLUFF:
-						return self.play_call_bluff()
-
-				else:
-					return PlayResult(fail_reason=intent.fail_reason)
-
-		if play.card not in self.player_cards[self.current_player]:
+		# Only the submitted action is checked
+		if play.action == ACTION_PLAY:
+
+			face = FACE_NUMBERS.get(play.card)
+			if face is None or not self.player_hands[player][face]:
+				return PlayResult(fail_reason='doesnt_have_card')
+
+			fail_reason = self.get_play_fail_reason(face)
+			if fail_reason:
+				return PlayResult(fail_reason=fail_reason)
+
+			return self.play_card(face, play.new_color)
+
+		elif play.action == ACTION_DRAW:
+			fail_reason = self.get_draw_fail_reason()
+			play_action = self.play_draw
+
+		elif play.action == ACTION_PASS:
+			fail_reason = self.get_pass_fail_reason()
+			play_action = self.play_pass
+
+		elif play.action == ACTION_CALL_BLUFF:
+			fail_reason = self.get_call_bluff_fail_reason()
+			play_action = self.play_call_bluff
+
+		else:
 			return PlayResult(fail_reason='doesnt_have_card')
 
+		if fail_reason:
+			return PlayResult(fail_reason=fail_reason)
+
+		return play_action()
 
-	def play_card(self, card, new_color):
+	def play_card(self, face, new_color):
 
 		# Clear previous bluff
 		self.can_call_bluff = False
 
 		# Check bluff
-		if card.kind == KIND_DRAW_4:
+		if FACE_KINDS[face] == KIND_DRAW_4:
 
 			self.can_call_bluff = True
 			self.previous_bluffed = False
 
 			# Check if any cards that aren't +4s could have been played,
 			# if there are then it is a bluff.
-			for intent in self.get_play_intents_cards(self.current_player):
-				if intent.can_play:
-					if intent.card.kind != KIND_DRAW_4:
-						self.previous_bluffed = True
-						break
+			self.previous_bluffed = self.could_play_other_than_draw_4(self.current_player)
 
 		# Make card the current card
-		self.set_current_card(card)
+		self.set_current_face(face)
 
 		# Remove card from player's hand
-		self.player_cards[self.current_player].remove(card)
+		self.remove_from_hand(self.current_player, face)
+
+		num_cards = self.num_player_cards(self.current_player)
 
 		# If no cards in hand, player wins
-		if len(self.player_cards[self.current_player]) == 0:
+		if num_cards == 0:
 			self.winner = self.current_player
 
 		# If one card in hand, say UNO
 		uno = False
-		if len(self.player_cards[self.current_player]) == 1:
+		if num_cards == 1:
 			uno = True
 
-		self.sort_player_cards(self.current_player)
-
 		# Special card effects
-		self.do_special_effects(card, new_color)
+		self.do_special_effects(face, new_color)
 
-		self.drawn_card = None
+		self.drawn_face = None
 
 		self.next_player()
 
 		self.current_play_number += 1
-		return PlayResult(success=True, action=ACTION_PLAY, card=card, new_color=new_color, uno=uno)
+		return PlayResult(success=True, action=ACTION_PLAY, card=CARD_FACES[face], new_color=new_color, uno=uno)
 
 	def play_draw(self):
 
@@ -211,11 +565,10 @@ class Game():
 
 			num_draw = self.draw_amount
 
-			self.player_cards[self.current_player] += list(self.pick_cards(self.draw_amount))
+			self.pick_cards_to_hand(self.current_player, self.draw_amount)
 
 			self.draw_amount = 0
 
-			self.sort_player_cards(self.current_player)
 			self.next_player()
 
 		# If not, pick only one card and continue playing
@@ -223,10 +576,8 @@ class Game():
 
 			num_draw = 1
 
-			self.sort_player_cards(self.current_player)
-
-			self.drawn_card = self.pick_card()
-			self.player_cards[self.current_player].append(self.drawn_card)
+			self.drawn_face = self.pick_card()
+			self.add_to_hand(self.current_player, self.drawn_face)
 
 		# Clear previous bluff
 		self.can_call_bluff = False
@@ -236,9 +587,8 @@ class Game():
 
 	def play_pass(self):
 
-		self.drawn_card = None
+		self.drawn_face = None
 
-		self.sort_player_cards(self.current_player)
 		self.next_player()
 
 		# Clear previous bluff
@@ -254,15 +604,14 @@ class Game():
 
 			num_draw = self.draw_amount
 
-			self.player_cards[self.previous_player] += list(self.pick_cards(num_draw))
-			self.sort_player_cards(self.previous_player)
+			self.pick_cards_to_hand(self.previous_player, num_draw)
 
 		# If not bluffed, current player has to draw stacked draw card amount plus 2
 		else:
 
 			num_draw = self.draw_amount + 2
 
-			self.player_cards[self.current_player] += list(self.pick_cards(num_draw))
+			self.pick_cards_to_hand(self.current_player, num_draw)
 
 		# Clear +4 effect
 		self.draw_amount = 0
@@ -270,12 +619,48 @@ class Game():
 		# Clear previous bluff
 		self.can_call_bluff = False
 
-		self.sort_player_cards(self.current_player)
 		self.next_player()
 
 		self.current_play_number += 1
 		return PlayResult(success=True, action=ACTION_CALL_BLUFF, bluffed=self.previous_bluffed, num_draw=num_draw, draw_pile_has_emptied=self.draw_pile_has_emptied)
 
+	def could_play_other_than_draw_4(self, player):
+
+		hand = self.player_hands[player]
+		color_counts = self.hand_color_counts[player]
+		kind_counts = self.hand_kind_counts[player]
+
+		# Config for only allowing last drawn card to be played
+		if not self.allow_play_non_drawn_cards and self.drawn_face is not None:
+			return (FACE_KINDS[self.drawn_face] != KIND_DRAW_4
+				and self.get_playability().fail_reasons[self.drawn_face] is None)
+
+		if self.draw_amount == 0:
+			# Wilds can always be played, other cards must match color or kind
+			if kind_counts[KIND_WILD]:
+				return True
+
+			if self.current_color and color_counts[self.current_color]:
+				return True
+
+			return self.current_kind not in (KIND_DRAW_4, KIND_WILD) and kind_counts[self.current_kind] != 0
+
+		# Only a +2 could be stacked
+		if self.current_kind == KIND_DRAW_2:
+			return kind_counts[KIND_DRAW_2] != 0
+
+		if self.current_kind == KIND_DRAW_4:
+			if self.draw_2_on_draw_4 == 'true':
+				face = FACE_NUMBERS.get(Card(KIND_DRAW_2, self.current_color))
+				return face is not None and hand[face] != 0
+
+			if self.draw_2_on_draw_4 == 'true_any_color':
+				return kind_counts[KIND_DRAW_2] != 0
+
+			return False
+
+		return len(self.sorted_hands[player]) > kind_counts[KIND_DRAW_4]
+
 	def get_play_intents(self, player):
 
 		# ACTION_PLAY
@@ -292,99 +677,142 @@ class Game():
 
 	def get_play_intents_cards(self, player):
 
-		for card in self.player_cards[player]:
-			yield self.get_play_intent_card(card, player)
+		if player != self.current_player:
+			for face in self.get_player_faces(player):
+				yield PlayIntent(ACTION_PLAY, CARD_FACES[face], can_play=False, fail_reason='not_current_player')
+			return
+
+		playability = self.get_playability()
+		intents = playability.intents
+		drawn_face = self.get_only_playable_face()
+
+		for face in self.get_player_faces(player):
+			if drawn_face is not None and face != drawn_face:
+				yield NOT_DRAWN_INTENTS[face]
+			else:
+				yield intents[face] or get_playability_intent(playability, face)
 
 	def get_play_intent_card(self, card, player):
+		return self.get_play_intent_face(FACE_NUMBERS[card], player)
+
+	def get_play_intent_face(self, face, player):
 
 		if player != self.current_player:
-			return PlayIntent(ACTION_PLAY, card, can_play=False, fail_reason='not_current_player')
+			return PlayIntent(ACTION_PLAY, CARD_FACES[face], can_play=False, fail_reason='not_current_player')
+
+		return self.get_face_intent(face)
+
+	def get_face_intent(self, face):
+
+		drawn_face = self.get_only_playable_face()
+		if drawn_face is not None and face != drawn_face:
+			return NOT_DRAWN_INTENTS[face]
+
+		return get_playability_intent(self.get_playability(), face)
+
+	def get_play_fail_reason(self, face):
+
+		drawn_face = self.get_only_playable_face()
+		if drawn_face is not None and face != drawn_face:
+			return 'not_drawn_card'
+
+		return self.get_playability().fail_reasons[face]
+
+	def get_playable_mask(self):
+
+		playable = self.get_playability().playable
+
+		drawn_face = self.get_only_playable_face()
+		if drawn_face is not None:
+			playable &= 1 << drawn_face
+
+		return playable
+
+	def get_only_playable_face(self):
 
 		# Config for only allowing last drawn card to be played
-		if not self.allow_play_non_drawn_cards:
-			if self.drawn_card:
-				if card != self.drawn_card:
-					return PlayIntent(ACTION_PLAY, card, can_play=False, fail_reason='not_drawn_card')
+		if self.allow_play_non_drawn_cards:
+			return None
 
-		# Check if draws are required
-		if self.draw_amount == 0:
-			# When no draw card has been played last
+		return self.drawn_face
 
-			# If card has color
-			if card.color != NO_COLOR:
-				# If card doesn't match current kind or color
-				if not (card.kind == self.current_kind or card.color == self.current_color):
-					return PlayIntent(ACTION_PLAY, card, can_play=False, fail_reason='card_doesnt_match')
+	def get_playability(self):
 
-		else:
-			# When draw card has been played last
-			
-			if self.current_kind == KIND_DRAW_2:
-				if card.kind != KIND_DRAW_2 and card.kind != KIND_DRAW_4:
-					return PlayIntent(ACTION_PLAY, card, can_play=False, fail_reason='not_draw_2_or_draw_4')
-
-			elif self.current_kind == KIND_DRAW_4:
-				if card.kind == KIND_DRAW_2:
-					if self.draw_2_on_draw_4 == 'false':
-						return PlayIntent(ACTION_PLAY, card, can_play=False, fail_reason='cant_draw_2_on_draw_4')
-					
-					if self.draw_2_on_draw_4 == 'true':
-						# Only allow if +2 is the chosen +4 color
-						if card.color != self.current_color:
-							return PlayIntent(ACTION_PLAY, card, can_play=False, fail_reason='draw_2_different_color')
-
-					if self.draw_2_on_draw_4 == 'true_any_color':
-						pass
-
-				elif card.kind == KIND_DRAW_4:
-					if not self.draw_4_on_draw_4:
-						return PlayIntent(ACTION_PLAY, card, can_play=False, fail_reason='cant_draw_4_on_draw_4')
-
-				else:
-					return PlayIntent(ACTION_PLAY, card, can_play=False, fail_reason='not_draw_2_or_draw_4')
-
-		return PlayIntent(ACTION_PLAY, card)
+		# The drawn card is checked apart, so the tables don't grow with each face
+		rules = (self.draw_4_on_draw_4, self.draw_2_on_draw_4)
+		situation = (self.current_kind, self.current_color, self.draw_amount != 0)
+
+		table = playability_tables.get(rules)
+		if table is None:
+			table = playability_tables[rules] = {}
+
+		playability = table.get(situation)
+		if playability is None:
+			playability = table[situation] = make_playability(rules, situation)
+
+		return playability
 
 	def get_play_intent_draw(self, player):
+		return make_action_intent(ACTION_DRAW, self.get_draw_fail_reason(player))
 
-		if player != self.current_player:
-			return PlayIntent(ACTION_DRAW, can_play=False, fail_reason='not_current_player')
+	def get_play_intent_pass(self, player):
+		return make_action_intent(ACTION_PASS, self.get_pass_fail_reason(player))
+
+	def get_play_intent_call_bluff(self, player):
+		return make_action_intent(ACTION_CALL_BLUFF, self.get_call_bluff_fail_reason(player))
+
+	def get_draw_fail_reason(self, player=None):
+
+		if player is not None and player != self.current_player:
+			return 'not_current_player'
 
 		# Config for allowing only one draw
 		if self.draw_pass_behavior == 'single_draw':
-			if self.drawn_card:
-				return PlayIntent(ACTION_DRAW, can_play=False, fail_reason='already_drew')
+			if self.drawn_face is not None:
+				return 'already_drew'
 
-		return PlayIntent(ACTION_DRAW)
+		return None
 
-	def get_play_intent_pass(self, player):
+	def get_pass_fail_reason(self, player=None):
 
-		if player != self.current_player:
-			return PlayIntent(ACTION_PASS, can_play=False, fail_reason='not_current_player')
+		if player is not None and player != self.current_player:
+			return 'not_current_player'
 
 		# Config for disallowing passing
 		if self.draw_pass_behavior == 'multiple_draws_disable_pass':
-			return PlayIntent(ACTION_PASS, can_play=False, fail_reason='cannot_pass')
+			return 'cannot_pass'
 
 		# Config for disallowing passing if has not drawn
 		if not self.allow_pass_without_draw:
-			if not self.drawn_card:
-				return PlayIntent(ACTION_PASS, can_play=False, fail_reason='hasnt_drawn')
+			if self.drawn_face is None:
+				return 'hasnt_drawn'
 
-		return PlayIntent(ACTION_PASS)
+		return None
 
-	def get_play_intent_call_bluff(self, player):
+	def get_call_bluff_fail_reason(self, player=None):
 
-		if player != self.current_player:
-			return PlayIntent(ACTION_CALL_BLUFF, can_play=False, fail_reason='not_current_player')
+		if player is not None and player != self.current_player:
+			return 'not_current_player'
 
 		if self.disable_call_bluff:
-			return PlayIntent(ACTION_CALL_BLUFF, can_play=False, fail_reason='bluff_disabled')
+			return 'bluff_disabled'
 
 		if not self.can_call_bluff:
-			return PlayIntent(ACTION_CALL_BLUFF, can_play=False, fail_reason='last_not_draw_4')
+			return 'last_not_draw_4'
 
-		return PlayIntent(ACTION_CALL_BLUFF)
+		return None
+
+	def legal_moves(self, player):
+
+		# Playable faces in the hand as a mask, and whether each other action can be made
+		if player != self.current_player:
+			return NO_LEGAL_MOVES
+
+		return LegalMoves(
+			cards=self.get_playable_mask() & self.hand_masks[player],
+			can_draw=self.get_draw_fail_reason() is None,
+			can_pass=self.get_pass_fail_reason() is None,
+			can_call_bluff=self.get_call_bluff_fail_reason() is None)
 
 	def get_next_player(self):
 		return (self.current_player + self.direction) % self.num_players
@@ -397,6 +825,16 @@ PlayResult = namedtuple('PlayResult',
 	defaults=(False, None, None, None, None, None, False, False, None,))
 PlayIntent = namedtuple('PlayIntent', ['action', 'card', 'can_play', 'fail_reason'],
 	defaults=(None, None, True, None,))
+HandSummary = namedtuple('HandSummary', ['num_cards', 'colors', 'kinds', 'wilds'])
+Playability = namedtuple('Playability', ['playable', 'fail_reasons', 'intents'])
+LegalMoves = namedtuple('LegalMoves', ['cards', 'can_draw', 'can_pass', 'can_call_bluff'])
+
+NO_LEGAL_MOVES = LegalMoves(0, False, False, False)
+
+def make_action_intent(action, fail_reason):
+	if fail_reason:
+		return PlayIntent(action, can_play=False, fail_reason=fail_reason)
+	return PlayIntent(action)
 
 def make_cards(kinds, colors, amount=1):
 	for kind in kinds:
@@ -410,4 +848,213 @@ def generate_starting_cards():
 	yield from make_cards([KIND_REVERSE, KIND_SKIP, KIND_DRAW_2], COLORS, amount=2)
 
 def generate_non_starting_cards():
-	yield from make_cards([KIND_WILD, KIND_DRAW_4], [NO_COLOR], amount=4)
\ No newline at end of file
+	yield from make_cards([KIND_WILD, KIND_DRAW_4], [NO_COLOR], amount=4)
+
+## Plays
+
+# Plays are encoded as small numbers to be stored: the action in the lowest
+# 2 bits, and for cards, the face in the next 6 bits and the new color after.
+
+def encode_play(play):
+	if play.action != ACTION_PLAY:
+		return play.action
+	return play.action | (FACE_NUMBERS[play.card] << 2) | ((play.new_color or NO_COLOR) << 8)
+
+def decode_play(code):
+	action = code & 3
+	if action != ACTION_PLAY:
+		return Play(action, None, None)
+	return Play(action, CARD_FACES[(code >> 2) & 63], (code >> 8) or None)
+
+## Storing
+
+# Games are stored as a header with every number in the game, followed by
+# the faces of each hand, of the draw pile and of the discard pile.
+# Anything that can be None is stored as a signed byte, with None as -1.
+
+GAME_BYTES_MAGIC = b'UNO'
+GAME_BYTES_VERSION = 1
+GAME_BYTES_HEADER = struct.Struct('<BBBbbbBbbbHHbbIQI')
+
+DRAW_2_ON_DRAW_4_VALUES = ('false', 'true', 'true_any_color')
+DRAW_PASS_BEHAVIOR_VALUES = ('single_draw', 'multiple_draws', 'multiple_draws_disable_pass')
+
+def encode_optional(number):
+	return -1 if number is None else number
+
+def decode_optional(number):
+	return None if number == -1 else number
+
+def index_or_none(values, value):
+	return values.index(value) if value in values else None
+
+## Configs
+
+# Same as the first (default) values of server.all_configs
+DEFAULT_CONFIGS = {
+	'draw_4_on_draw_4': 'false',
+	'draw_2_on_draw_4': 'false',
+	'disable_call_bluff': 'false',
+	'allow_play_non_drawn_cards': 'false',
+	'allow_pass_without_draw': 'false',
+	'draw_pass_behavior': 'single_draw',
+}
+
+def parse_configs(config_strings):
+	# From 'config=value' strings, as given to command line tools
+	configs = {}
+	for config_string in config_strings:
+		config, value = config_string.split('=', 1)
+		if config not in DEFAULT_CONFIGS:
+			raise ValueError('Unknown config ' + config)
+		configs[config] = value
+	return configs
+
+## Card faces
+
+# Each of the 54 different cards is a face, numbered by its index in CARD_FACES.
+# Faces are ordered by color and then kind, so a hand stored as an amount of
+# each face is always in the same order it's shown to players.
+CARD_FACES = sorted(set(generate_starting_cards()) | set(generate_non_starting_cards()),
+	key=lambda card: (card.color, card.kind))
+NUM_FACES = len(CARD_FACES)
+
+FACE_NUMBERS = {card: face for face, card in enumerate(CARD_FACES)}
+FACE_KINDS = bytes(card.kind for card in CARD_FACES)
+FACE_COLORS = bytes(card.color for card in CARD_FACES)
+
+# Every game starts from the same deck, allowed start cards first
+STARTING_FACES = bytes(FACE_NUMBERS[card] for card in generate_starting_cards())
+NON_STARTING_FACES = bytes(FACE_NUMBERS[card] for card in generate_non_starting_cards())
+DECK_TEMPLATE = STARTING_FACES + NON_STARTING_FACES
+DECK_SIZE = len(DECK_TEMPLATE)
+
+## Playability
+
+# Which faces can be played only depends on the rules and on a few things about
+# the current situation, so each combination is worked out once and shared by
+# all games with the same rules. Only playing the drawn card is checked by the
+# game itself, and intents are made when first asked for.
+playability_tables = {}
+
+def make_playability(rules, situation):
+
+	fail_reasons = tuple(get_face_fail_reason(face, rules, situation) for face in range(NUM_FACES))
+
+	playable = 0
+	for face in range(NUM_FACES):
+		if fail_reasons[face] is None:
+			playable |= 1 << face
+
+	return Playability(playable, fail_reasons, [None] * NUM_FACES)
+
+def get_playability_intent(playability, face):
+
+	intent = playability.intents[face]
+	if intent is None:
+		intent = playability.intents[face] = make_face_intent(face, playability.fail_reasons[face])
+
+	return intent
+
+def make_face_intent(face, fail_reason):
+
+	if fail_reason:
+		return PlayIntent(ACTION_PLAY, CARD_FACES[face], can_play=False, fail_reason=fail_reason)
+
+	return PlayIntent(ACTION_PLAY, CARD_FACES[face])
+
+NOT_DRAWN_INTENTS = tuple(make_face_intent(face, 'not_drawn_card') for face in range(NUM_FACES))
+
+def get_face_fail_reason(face, rules, situation):
+
+	draw_4_on_draw_4, draw_2_on_draw_4 = rules
+	current_kind, current_color, drawing = situation
+
+	kind = FACE_KINDS[face]
+	color = FACE_COLORS[face]
+
+	# Check if draws are required
+	if not drawing:
+		# When no draw card has been played last
+
+		# If card has color
+		if color != NO_COLOR:
+			# If card doesn't match current kind or color
+			if not (kind == current_kind or color == current_color):
+				return 'card_doesnt_match'
+
+	else:
+		# When draw card has been played last
+
+		if current_kind == KIND_DRAW_2:
+			if kind != KIND_DRAW_2 and kind != KIND_DRAW_4:
+				return 'not_draw_2_or_draw_4'
+
+		elif current_kind == KIND_DRAW_4:
+			if kind == KIND_DRAW_2:
+				if draw_2_on_draw_4 == 'false':
+					return 'cant_draw_2_on_draw_4'
+
+				if draw_2_on_draw_4 == 'true':
+					# Only allow if +2 is the chosen +4 color
+					if color != current_color:
+						return 'draw_2_different_color'
+
+				if draw_2_on_draw_4 == 'true_any_color':
+					pass
+
+			elif kind == KIND_DRAW_4:
+				if not draw_4_on_draw_4:
+					return 'cant_draw_4_on_draw_4'
+
+			else:
+				return 'not_draw_2_or_draw_4'
+
+	return None
+
+def copy_game_state(state):
+	state = state.copy()
+	state['pile'] = state['pile'][:]
+	state['player_hands'] = [hand[:] for hand in state['player_hands']]
+	state['sorted_hands'] = [faces[:] for faces in state['sorted_hands']]
+	state['hand_color_counts'] = [counts[:] for counts in state['hand_color_counts']]
+	state['hand_kind_counts'] = [counts[:] for counts in state['hand_kind_counts']]
+	state['hand_masks'] = state['hand_masks'][:]
+	return state
+
+def make_seed():
+	return random.SystemRandom().getrandbits(64)
+
+def get_mask_faces(mask):
+	while mask:
+		low = mask & -mask
+		yield low.bit_length() - 1
+		mask ^= low
+
+def get_counted_faces(hand):
+	for face in range(NUM_FACES):
+		for x in range(hand[face]):
+			yield face
+
+def convert_card_list_state(state):
+
+	state = dict(state)
+
+	player_hands = []
+	for cards in state.pop('player_cards'):
+		hand = bytearray(NUM_FACES)
+		for card in cards:
+			hand[FACE_NUMBERS[card]] += 1
+		player_hands.append(hand)
+
+	state['player_hands'] = player_hands
+	state['draw_pile'] = bytearray(FACE_NUMBERS[card] for card in state['draw_pile'])
+	state['discard_pile'] = bytearray(FACE_NUMBERS[card] for card in state['discard_pile'])
+
+	current_card = state.pop('current_card')
+	state['current_face'] = FACE_NUMBERS[current_card] if current_card else None
+
+	drawn_card = state.pop('drawn_card')
+	state['drawn_face'] = FACE_NUMBERS[drawn_card] if drawn_card else None
+
+	return state
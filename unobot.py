@@ -0,0 +1,251 @@
+# Computer player, picks plays with information set Monte Carlo tree search.
+# One tree is grown over many determinized games, where the cards the bot
+# can't see are dealt again at random on every iteration. Several trees are
+# grown at once in worker processes, and their visits are added up.
+
+import concurrent.futures
+import math
+import random
+import time
+
+import uno
+
+# Seconds each play may take to be picked
+TIME_BUDGET = 0.2
+# Worker processes, each growing its own tree for the whole time budget
+NUM_WORKERS = 2
+
+# Plays after which a rollout is scored by the cards left in each hand
+MAX_ROLLOUT_PLAYS = 60
+EXPLORATION = 0.7
+
+# Bots are seats in uno_joins with a negative user id, made from the room
+MAX_BOTS_PER_ROOM = 9
+
+executor, num_workers = None, 0
+
+## Bot users
+
+def is_bot(user_id):
+	return user_id < 0
+
+def make_bot_user_id(room_id, bot_number):
+	return -(room_id * MAX_BOTS_PER_ROOM + bot_number + 1)
+
+def get_bot_number(user_id):
+	return (-user_id - 1) % MAX_BOTS_PER_ROOM
+
+def get_bot_name(user_id):
+	return 'Bot ' + str(get_bot_number(user_id) + 1)
+
+## Picking plays
+
+def start_workers(workers=None):
+	global executor, num_workers
+	if executor is None:
+		num_workers = workers or NUM_WORKERS
+		executor = concurrent.futures.ProcessPoolExecutor(num_workers)
+	return executor
+
+def choose_play(game, player, time_budget=None):
+
+	moves = get_moves(game, player)
+	if len(moves) == 1:
+		return next(iter(moves.values()))
+
+	time_budget = time_budget or TIME_BUDGET
+	data = game.to_bytes()
+
+	# Started first, as that's what sets how many workers there are
+	workers = start_workers()
+	futures = [workers.submit(search, data, player, time_budget, None, random.getrandbits(64))
+		for x in range(num_workers)]
+
+	visits = {}
+	for future in futures:
+		for code, count in future.result().items():
+			visits[code] = visits.get(code, 0) + count
+
+	return uno.decode_play(get_best_code(visits))
+
+def get_best_code(visits):
+	return max(visits, key=visits.get)
+
+def search(data, player, time_budget=None, max_iterations=None, seed=None):
+
+	# Runs until the time budget or the number of iterations is used up,
+	# and returns how many times each play was visited from the root
+	game = uno.Game.from_bytes(data)
+	rng = random.Random(seed)
+	root = Node(None)
+
+	deadline = time.perf_counter() + time_budget if time_budget else None
+	iterations = 0
+
+	while True:
+		if deadline is not None and time.perf_counter() >= deadline:
+			break
+		if max_iterations is not None and iterations >= max_iterations:
+			break
+
+		run_iteration(root, game, player, rng)
+		iterations += 1
+
+	return {code: child.visits for code, child in root.children.items()}
+
+## Tree
+
+class Node():
+
+	__slots__ = ('player', 'visits', 'wins', 'availability', 'children')
+
+	def __init__(self, player):
+		# Player that made the play leading to this node
+		self.player = player
+		self.visits = 0
+		self.wins = 0.0
+		self.availability = 0
+		self.children = {}
+
+	def get_score(self):
+		return self.wins / self.visits + EXPLORATION * math.sqrt(math.log(self.availability) / self.visits)
+
+def run_iteration(root, game, player, rng):
+
+	state = determinize(game, player, rng)
+	node = root
+	path = [root]
+
+	try:
+		# Go down the tree by plays possible in this determinization, until a new one
+		while state.winner is None:
+			moves = get_moves(state, state.current_player)
+
+			untried = []
+			for code in moves:
+				child = node.children.get(code)
+				if child:
+					child.availability += 1
+				else:
+					untried.append(code)
+
+			if untried:
+				code = rng.choice(untried)
+			else:
+				code = max(moves, key=lambda code: node.children[code].get_score())
+
+			# New plays only get a node once made, so no node is left unvisited
+			mover = state.current_player
+			state.play(mover, moves[code])
+
+			child = node.children.get(code)
+			if child is None:
+				node.children[code] = child = Node(mover)
+				child.availability = 1
+
+			node = child
+			path.append(node)
+
+			if untried:
+				break
+
+		rollout(state, rng)
+
+	except IndexError:
+		# Every card is in someone's hand
+		pass
+
+	scores = get_scores(state)
+
+	for node in path:
+		node.visits += 1
+		if node.player is not None:
+			node.wins += scores[node.player]
+
+def determinize(game, player, rng):
+
+	# Cards in other hands and in the draw pile are dealt again, the same
+	# amount to each place, since the player doesn't know where they are
+	state = game.clone()
+
+	unseen = bytearray(state.draw_pile)
+	for other in range(state.num_players):
+		if other != player:
+			unseen += state.sorted_hands[other]
+
+	rng.shuffle(unseen)
+
+	start = 0
+	for other in range(state.num_players):
+		if other != player:
+			end = start + len(state.sorted_hands[other])
+			state.set_hand(other, unseen[start:end])
+			start = end
+
+	state.set_piles(unseen[start:], state.discard_pile)
+
+	# Whether the last +4 was a bluff is only known by who played it
+	if state.can_call_bluff and state.previous_player != player:
+		state.previous_bluffed = rng.random() < 0.5
+
+	# And shuffles to come aren't known by anyone
+	state.seed = rng.getrandbits(64)
+	state.num_random_events = 0
+
+	return state
+
+def rollout(state, rng):
+
+	# Random cards are played when possible, else some other random action
+	for x in range(MAX_ROLLOUT_PLAYS):
+		if state.winner is not None:
+			return
+
+		moves = list(get_moves(state, state.current_player).values())
+		cards = [play for play in moves if play.action == uno.ACTION_PLAY]
+
+		state.play(state.current_player, rng.choice(cards or moves))
+
+def get_scores(state):
+
+	if state.winner is not None:
+		scores = [0.0] * state.num_players
+		scores[state.winner] = 1.0
+		return scores
+
+	# Unfinished games go to whoever has the fewest cards
+	fewest = min(state.num_player_cards(player) for player in range(state.num_players))
+	leaders = [player for player in range(state.num_players) if state.num_player_cards(player) == fewest]
+
+	return [1.0 / len(leaders) if player in leaders else 0.0 for player in range(state.num_players)]
+
+def get_moves(game, player):
+
+	# Possible plays of the current player by their codes. Colorless cards
+	# only get the color the player has the most of, so the tree doesn't
+	# branch four times for them.
+	color_counts = game.hand_color_counts[player]
+	new_color = max(uno.COLORS, key=color_counts.__getitem__)
+
+	legal_moves = game.legal_moves(player)
+
+	moves = {}
+	for face in uno.get_mask_faces(legal_moves.cards):
+		code, play = CARD_MOVES[face, new_color if uno.FACE_COLORS[face] == uno.NO_COLOR else None]
+		moves[code] = play
+
+	for action, can_play in ((uno.ACTION_DRAW, legal_moves.can_draw),
+			(uno.ACTION_PASS, legal_moves.can_pass), (uno.ACTION_CALL_BLUFF, legal_moves.can_call_bluff)):
+		if can_play:
+			code, play = ACTION_MOVES[action]
+			moves[code] = play
+
+	return moves
+
+def make_move(play):
+	return uno.encode_play(play), play
+
+CARD_MOVES = {(face, new_color): make_move(uno.Play(uno.ACTION_PLAY, uno.CARD_FACES[face], new_color))
+	for face in range(uno.NUM_FACES) for new_color in uno.COLORS + [None]}
+ACTION_MOVES = {action: make_move(uno.Play(action, None, None))
+	for action in (uno.ACTION_DRAW, uno.ACTION_PASS, uno.ACTION_CALL_BLUFF)}
@@ -1,19 +1,42 @@
+from collections import namedtuple
+
 import uno
 
 from plural import plural
 
-KIND_STRINGS_SHORT = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', 'R', 'S', '+2', '+4', 'W']
-KIND_STRINGS_LONG = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', 'Reverse', 'Skip', 'Draw 2', 'Draw 4', 'Wild']
+KIND_STRINGS_SHORT = ('0', '1', '2', '3', '4', '5', '6', '7', '8', '9', 'R', 'S', '+2', '+4', 'W')
+KIND_STRINGS_LONG = ('0', '1', '2', '3', '4', '5', '6', '7', '8', '9', 'Reverse', 'Skip', 'Draw 2', 'Draw 4', 'Wild')
+
+COLOR_STRINGS_SHORT = ('', 'b', 'g', 'r', 'y')
+COLOR_STRINGS_EMOJI = ('⬛', '🟦', '🟩', '🟥', '🟨')
+COLOR_STRINGS_CIRCLE = ('⚫', '🔵', '🟢', '🔴', '🟡')
+COLOR_STRINGS_HEART = ('🖤', '💙', '💚', '❤️', '💛')
+COLOR_STRINGS_LONG = ('', 'Blue', 'Green', 'Red', 'Yellow')
+
+# Color and kind strings of each style setting
+STYLE_STRINGS = {
+	'short': (COLOR_STRINGS_SHORT, KIND_STRINGS_SHORT),
+	'emoji': (COLOR_STRINGS_EMOJI, KIND_STRINGS_SHORT),
+	'circle': (COLOR_STRINGS_CIRCLE, KIND_STRINGS_SHORT),
+	'heart': (COLOR_STRINGS_HEART, KIND_STRINGS_SHORT),
+	'long': (COLOR_STRINGS_LONG, KIND_STRINGS_LONG),
+}
+
+# How a user sees things, from their settings and the room's configs
+RenderProfile = namedtuple('RenderProfile', ['color_strings', 'kind_strings', 'highlight_playable', 'show_play_number'])
 
-KIND_STRINGS = KIND_STRINGS_SHORT
+# Every profile is made once and shared, so none of them is ever changed
+RENDER_PROFILES = {
+	(style, highlight_playable, show_play_number): RenderProfile(color_strings, kind_strings, highlight_playable, show_play_number)
+	for style, (color_strings, kind_strings) in STYLE_STRINGS.items()
+	for highlight_playable in (False, True)
+	for show_play_number in (False, True)
+}
 
-COLOR_STRINGS_SHORT = ['', 'b', 'g', 'r', 'y']
-COLOR_STRINGS_EMOJI = ['⬛', '🟦', '🟩', '🟥', '🟨']
-COLOR_STRINGS_CIRCLE = ['⚫', '🔵', '🟢', '🔴', '🟡']
-COLOR_STRINGS_HEART = ['🖤', '💙', '💚', '❤️', '💛']
-COLOR_STRINGS_LONG = ['', 'Blue', 'Green', 'Red', 'Yellow']
+def get_render_profile(style='short', highlight_playable=True, show_play_number=False):
+	return RENDER_PROFILES.get((style, highlight_playable, show_play_number)) or RENDER_PROFILES['short', highlight_playable, show_play_number]
 
-COLOR_STRINGS = COLOR_STRINGS_SHORT
+DEFAULT_PROFILE = get_render_profile()
 
 ACTION_CMD_STRINGS = {
 	'd': uno.ACTION_DRAW,
@@ -69,28 +92,28 @@ COLOR_CMD_STRINGS = {
 	'yellow': uno.COLOR_YELLOW,
 }
 
-HIGHLIGHT_PLAYABLE = True
+HIGHLIGHT_STRING = "<u>{}</u>"
 
-def card_string(card):
-	return ''.join(x for x in [card_color_string(card.color), card_kind_string(card.kind)] if x)
+def card_string(card, profile=DEFAULT_PROFILE):
+	return ''.join(x for x in [card_color_string(card.color, profile), card_kind_string(card.kind, profile)] if x)
 
-def card_list_string(card_list):
-	return ", ".join([card_string(card) for card in card_list])
+def card_list_string(card_list, profile=DEFAULT_PROFILE):
+	return ", ".join([card_string(card, profile) for card in card_list])
 
-def card_kind_string(card_kind):
-	return KIND_STRINGS[card_kind]
+def card_kind_string(card_kind, profile=DEFAULT_PROFILE):
+	return profile.kind_strings[card_kind]
 
-def card_color_string(card_color):
-	return COLOR_STRINGS[card_color]
+def card_color_string(card_color, profile=DEFAULT_PROFILE):
+	return profile.color_strings[card_color]
 
-def play_intent_string(play_intent):
-	if play_intent.can_play and HIGHLIGHT_PLAYABLE:
-		f_string = "<u>{}</u>"
+def play_intent_string(play_intent, profile=DEFAULT_PROFILE):
+	if play_intent.can_play and profile.highlight_playable:
+		f_string = HIGHLIGHT_STRING
 	else:
 		f_string = "{}"
 
 	if play_intent.action == uno.ACTION_PLAY:
-		return f_string.format(card_string(play_intent.card))
+		return f_string.format(card_string(play_intent.card, profile))
 	elif play_intent.action == uno.ACTION_DRAW:
 		return f_string.format("Draw")
 	elif play_intent.action == uno.ACTION_PASS:
@@ -98,20 +121,29 @@ def play_intent_string(play_intent):
 	elif play_intent.action == uno.ACTION_CALL_BLUFF:
 		return f_string.format("Call bluff")
 
-def play_intent_list_string(play_intent_list):
-	return ", ".join((play_intent_string(play_intent) for play_intent in play_intent_list))
+def play_intent_list_string(play_intent_list, profile=DEFAULT_PROFILE):
+	return ", ".join((play_intent_string(play_intent, profile) for play_intent in play_intent_list))
+
+def hand_string(faces, legal_cards=0, profile=DEFAULT_PROFILE):
+	# Faces of a hand, with the ones in the legal cards mask (from uno.Game.legal_moves) highlighted
+	return ", ".join((face_string(face, legal_cards >> face & 1, profile) for face in faces))
+
+def face_string(face, can_play=False, profile=DEFAULT_PROFILE):
+	if can_play and profile.highlight_playable:
+		return HIGHLIGHT_STRING.format(card_string(uno.CARD_FACES[face], profile))
+	return card_string(uno.CARD_FACES[face], profile)
 
-def play_result_string(play_result, current_player_name, last_player_name=None):
+def play_result_string(play_result, current_player_name, last_player_name=None, profile=DEFAULT_PROFILE):
 
 	string = str(current_player_name) + ' '
 
 	if play_result.action == uno.ACTION_PLAY:
 		string += 'played '
 
-		string += card_string(play_result.card)
+		string += card_string(play_result.card, profile)
 
 		if play_result.new_color:
-			string += ' with new color ' + card_color_string(play_result.new_color)
+			string += ' with new color ' + card_color_string(play_result.new_color, profile)
 		
 		string += '.'
 
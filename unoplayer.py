@@ -71,7 +71,7 @@ def status():
 
 	for for_player_number in player_numbers:
 
-		num_cards = len(game.player_cards[for_player_number])
+		num_cards = game.num_player_cards(for_player_number)
 		text += str(for_player_number) + ': ' + str(num_cards) + ' ' + plural(num_cards, 'card', 'cards')
 
 		if game.winner == None:
@@ -92,8 +92,8 @@ def status():
 
 	text += 'Your cards: '
 	
-	if len(game.player_cards[player_number]) != 0:
-		text += unoparser.play_intent_list_string(game.get_play_intents_cards(player_number))
+	if game.num_player_cards(player_number) != 0:
+		text += unoparser.hand_string(game.get_player_faces(player_number), game.legal_moves(player_number).cards)
 	else:
 		text += 'None!'
 
@@ -130,13 +130,14 @@ def parse_play(message):
 		return None
 
 	if message == 'give +4':
-		game.player_cards[game.current_player] += [uno.Card(uno.KIND_DRAW_4, uno.NO_COLOR)]
+		game.add_to_hand(game.current_player, uno.FACE_NUMBERS[uno.Card(uno.KIND_DRAW_4, uno.NO_COLOR)])
 		raise InputParsingError('CHEAT: GIVE +4')
 	if message == 'clear cards':
-		game.player_cards[game.current_player] = []
+		game.clear_hand(game.current_player)
 		raise InputParsingError('CHEAT: CLEAR CARDS')
 	if message == 'give r':
-		game.player_cards[game.current_player] += [uno.Card(uno.KIND_REVERSE, color) for color in uno.COLORS]
+		for color in uno.COLORS:
+			game.add_to_hand(game.current_player, uno.FACE_NUMBERS[uno.Card(uno.KIND_REVERSE, color)])
 		raise InputParsingError('CHEAT: GIVE R')
 
 	return unoparser.parse_play(message)
@@ -0,0 +1,472 @@
+# Batch game simulator, plays thousands of games at once in lock-step with
+# NumPy arrays (one row per game). It follows the rules of uno.Game, and can
+# replay some of its games through uno.Game to check both agree.
+
+import argparse
+from collections import namedtuple
+import time
+
+import numpy as np
+
+import uno
+
+# Face number meaning "no card", used for the drawn card
+NO_FACE = uno.NUM_FACES
+
+FACE_KINDS = np.frombuffer(uno.FACE_KINDS, dtype=np.uint8).astype(np.int64)
+FACE_COLORS = np.frombuffer(uno.FACE_COLORS, dtype=np.uint8).astype(np.int64)
+NOT_DRAW_4_FACES = FACE_KINDS != uno.KIND_DRAW_4
+COLORLESS_FACES = FACE_COLORS == uno.NO_COLOR
+
+STARTING_DECK = np.frombuffer(uno.STARTING_FACES, dtype=np.uint8).astype(np.int64)
+NON_STARTING_DECK = np.frombuffer(uno.NON_STARTING_FACES, dtype=np.uint8).astype(np.int64)
+DECK_SIZE = uno.DECK_SIZE
+
+# Chance that a simulated player calls a bluff when they can
+CALL_BLUFF_CHANCE = 0.5
+
+class Simulator():
+
+	def __init__(self, num_games, num_players, configs=None, seed=None, max_plays=1000, num_recorded=0):
+
+		self.num_games = num_games
+		self.num_players = num_players
+		self.max_plays = max_plays
+
+		# Rules are read from an uno.Game, so configs mean exactly the same
+		self.configs = {**uno.DEFAULT_CONFIGS, **(configs or {})}
+		self.rules = uno.Game()
+		self.rules.apply_configs(self.configs)
+		self.playable_table = make_playable_table(self.rules)
+
+		self.rng = np.random.default_rng(seed)
+
+		# Games whose plays are recorded, to be replayed through uno.Game
+		self.recorded_games = np.sort(self.rng.choice(num_games, size=min(num_recorded, num_games), replace=False))
+		self.records = {}
+
+	def begin(self):
+
+		n = self.num_games
+		games = np.arange(n)
+
+		self.hands = np.zeros((n, self.num_players, uno.NUM_FACES), dtype=np.int64)
+		self.draw_pile = np.zeros((n, DECK_SIZE), dtype=np.int64)
+		self.draw_count = np.zeros(n, dtype=np.int64)
+		self.discard_pile = np.zeros((n, DECK_SIZE), dtype=np.int64)
+		self.discard_count = np.zeros(n, dtype=np.int64)
+
+		self.current_face = np.zeros(n, dtype=np.int64)
+		self.current_kind = np.zeros(n, dtype=np.int64)
+		self.current_color = np.zeros(n, dtype=np.int64)
+		self.current_player = np.zeros(n, dtype=np.int64)
+		self.previous_player = np.full(n, -1, dtype=np.int64)
+		self.direction = np.ones(n, dtype=np.int64)
+		self.drawn_face = np.full(n, NO_FACE, dtype=np.int64)
+		self.draw_amount = np.zeros(n, dtype=np.int64)
+		self.can_call_bluff = np.zeros(n, dtype=bool)
+		self.previous_bluffed = np.zeros(n, dtype=bool)
+		self.winner = np.full(n, -1, dtype=np.int64)
+		self.play_number = np.zeros(n, dtype=np.int64)
+		self.ran_out = np.zeros(n, dtype=bool)
+		self.active = np.ones(n, dtype=bool)
+
+		# Pick starting card from the cards allowed to start with
+		starting = np.tile(STARTING_DECK, (n, 1))
+		start_index = self.rng.integers(len(STARTING_DECK), size=n)
+		start_face = starting[games, start_index]
+		starting[games, start_index] = starting[:, -1]
+
+		# Every other card goes to the draw pile, shuffled
+		rest = np.concatenate((starting[:, :-1], np.tile(NON_STARTING_DECK, (n, 1))), axis=1)
+		rest = np.take_along_axis(rest, self.rng.random(rest.shape).argsort(axis=1), axis=1)
+		self.draw_pile[:, :DECK_SIZE-1] = rest
+		self.draw_count[:] = DECK_SIZE-1
+
+		self.set_current_face(games, start_face, FACE_COLORS[start_face])
+		self.do_special_effects(games, start_face)
+
+		# Pick player cards
+		for player in range(self.num_players):
+			players = np.full(n, player)
+			for x in range(self.rules.starting_num_player_cards):
+				self.pick_card_to_hand(games, players)
+
+		for game in self.recorded_games.tolist():
+			self.records[game] = Record(self.get_position(game), [], [])
+
+	def run(self):
+
+		self.begin()
+
+		while self.active.any():
+			self.step()
+
+		return self.get_results()
+
+	def step(self):
+
+		games = np.flatnonzero(self.active)
+		players = self.current_player[games]
+
+		actions, faces, new_colors, could_play_other = self.choose_plays(games, players)
+
+		for index in np.flatnonzero(np.isin(games, self.recorded_games)).tolist():
+			self.record_play(int(games[index]), int(actions[index]), int(faces[index]), int(new_colors[index]))
+
+		is_play = actions == uno.ACTION_PLAY
+		is_draw = actions == uno.ACTION_DRAW
+		is_pass = actions == uno.ACTION_PASS
+		is_call_bluff = actions == uno.ACTION_CALL_BLUFF
+
+		self.play_cards(games[is_play], faces[is_play], new_colors[is_play], could_play_other[is_play])
+		self.play_draws(games[is_draw])
+		self.play_passes(games[is_pass])
+		self.play_call_bluffs(games[is_call_bluff])
+
+		self.play_number[games] += 1
+
+		self.active[games] = (self.winner[games] == -1) & ~self.ran_out[games] & (self.play_number[games] < self.max_plays)
+
+	def record_play(self, game, action, face, new_color):
+
+		card, play_new_color = None, None
+
+		if action == uno.ACTION_PLAY:
+			card = uno.CARD_FACES[face]
+			if card.color == uno.NO_COLOR:
+				play_new_color = new_color
+
+		self.records[game].plays.append(uno.Play(action, card, play_new_color))
+
+	## Rules
+
+	def get_playable(self, games):
+
+		drawn_faces = self.drawn_face[games]
+
+		# Config for only allowing last drawn card to be played
+		if self.rules.allow_play_non_drawn_cards:
+			drawn_faces = np.full(len(games), NO_FACE)
+
+		return self.playable_table[self.current_kind[games], self.current_color[games],
+			(self.draw_amount[games] != 0).astype(np.int64), drawn_faces]
+
+	def choose_plays(self, games, players):
+
+		# Simulated players play a random card they can, otherwise they draw,
+		# and pass when they can't draw anymore. Bluffs are called by chance.
+
+		n = len(games)
+
+		legal = (self.hands[games, players] > 0) & self.get_playable(games)
+		has_legal = legal.any(axis=1)
+		could_play_other = (legal & NOT_DRAW_4_FACES).any(axis=1)
+
+		weights = self.rng.random(legal.shape)
+		weights[~legal] = -1
+		faces = weights.argmax(axis=1)
+
+		new_colors = self.rng.integers(uno.COLOR_BLUE, uno.COLOR_YELLOW + 1, size=n)
+
+		has_drawn = self.drawn_face[games] != NO_FACE
+
+		can_draw = np.ones(n, dtype=bool)
+		if self.rules.draw_pass_behavior == 'single_draw':
+			can_draw = ~has_drawn
+
+		can_call_bluff = self.can_call_bluff[games] & (not self.rules.disable_call_bluff)
+		call_bluff = can_call_bluff & (self.rng.random(n) < CALL_BLUFF_CHANCE)
+
+		actions = np.select(
+			[call_bluff, has_legal, can_draw],
+			[uno.ACTION_CALL_BLUFF, uno.ACTION_PLAY, uno.ACTION_DRAW],
+			uno.ACTION_PASS)
+
+		return actions, faces, new_colors, could_play_other
+
+	def play_cards(self, games, faces, new_colors, could_play_other):
+
+		players = self.current_player[games]
+		kinds = FACE_KINDS[faces]
+
+		# Check bluff
+		is_draw_4 = kinds == uno.KIND_DRAW_4
+		self.can_call_bluff[games] = is_draw_4
+		self.previous_bluffed[games[is_draw_4]] = could_play_other[is_draw_4]
+
+		colors = np.where(COLORLESS_FACES[faces], new_colors, FACE_COLORS[faces])
+		self.set_current_face(games, faces, colors)
+
+		self.hands[games, players, faces] -= 1
+
+		# If no cards in hand, player wins
+		won = self.hands[games, players].sum(axis=1) == 0
+		self.winner[games[won]] = players[won]
+
+		self.do_special_effects(games, faces)
+
+		self.drawn_face[games] = NO_FACE
+
+		self.next_player(games)
+
+	def play_draws(self, games):
+
+		drawing = self.draw_amount[games] != 0
+
+		# If draw card has been played last, pick up those cards
+		stacked = games[drawing]
+		self.pick_cards_to_hand(stacked, self.current_player[stacked], self.draw_amount[stacked])
+		self.draw_amount[stacked] = 0
+		self.next_player(stacked)
+
+		# If not, pick only one card and continue playing
+		single = games[~drawing]
+		self.drawn_face[single] = self.pick_card_to_hand(single, self.current_player[single])
+
+		self.can_call_bluff[games] = False
+
+	def play_passes(self, games):
+
+		self.drawn_face[games] = NO_FACE
+		self.next_player(games)
+		self.can_call_bluff[games] = False
+
+	def play_call_bluffs(self, games):
+
+		bluffed = self.previous_bluffed[games]
+
+		# If bluffed, previous player has to draw stacked draw card amount,
+		# if not, current player has to draw stacked draw card amount plus 2
+		players = np.where(bluffed, self.previous_player[games], self.current_player[games])
+		amounts = np.where(bluffed, self.draw_amount[games], self.draw_amount[games] + 2)
+		self.pick_cards_to_hand(games, players, amounts)
+
+		self.draw_amount[games] = 0
+		self.can_call_bluff[games] = False
+		self.next_player(games)
+
+	def do_special_effects(self, games, faces):
+
+		kinds = FACE_KINDS[faces]
+
+		reverse = games[kinds == uno.KIND_REVERSE]
+		self.direction[reverse] = -self.direction[reverse]
+
+		# When it's only 2 players, reverse works like skip
+		if self.num_players == 2:
+			self.next_player(reverse)
+
+		self.next_player(games[kinds == uno.KIND_SKIP])
+
+		self.draw_amount[games[kinds == uno.KIND_DRAW_2]] += 2
+		self.draw_amount[games[kinds == uno.KIND_DRAW_4]] += 4
+
+	def set_current_face(self, games, faces, colors):
+		self.current_face[games] = faces
+		self.current_kind[games] = FACE_KINDS[faces]
+		self.current_color[games] = colors
+		self.discard_pile[games, self.discard_count[games]] = faces
+		self.discard_count[games] += 1
+
+	def next_player(self, games):
+		self.previous_player[games] = self.current_player[games]
+		self.current_player[games] = (self.current_player[games] + self.direction[games]) % self.num_players
+
+	## Piles
+
+	def pick_card_to_hand(self, games, players):
+
+		faces = np.full(len(games), NO_FACE)
+
+		# When the draw pile empties, the discard pile goes back to it
+		for game in games[self.draw_count[games] == 0]:
+			self.recycle_discard_pile(game)
+
+		can_pick = self.draw_count[games] != 0
+		self.ran_out[games[~can_pick]] = True
+		games, players = games[can_pick], players[can_pick]
+
+		self.draw_count[games] -= 1
+		picked = self.draw_pile[games, self.draw_count[games]]
+		self.hands[games, players, picked] += 1
+
+		faces[can_pick] = picked
+		return faces
+
+	def pick_cards_to_hand(self, games, players, amounts):
+		for x in range(amounts.max(initial=0)):
+			picking = amounts > x
+			self.pick_card_to_hand(games[picking], players[picking])
+
+	def recycle_discard_pile(self, game):
+
+		count = self.discard_count[game]
+		if count <= 1:
+			return
+
+		cards = self.rng.permutation(self.discard_pile[game, :count-1])
+		self.draw_pile[game, :count-1] = cards
+		self.draw_count[game] = count-1
+
+		self.discard_pile[game, 0] = self.discard_pile[game, count-1]
+		self.discard_count[game] = 1
+
+		if int(game) in self.records:
+			self.records[int(game)].shuffles.append(bytes(cards.astype(np.uint8)))
+
+	## Results
+
+	def get_results(self):
+
+		finished = self.winner != -1
+
+		return Results(
+			num_games=self.num_games,
+			num_finished=int(finished.sum()),
+			num_ran_out=int(self.ran_out.sum()),
+			wins_per_seat=np.bincount(self.winner[finished], minlength=self.num_players).tolist(),
+			average_plays=float(self.play_number[finished].mean()) if finished.any() else 0.0,
+		)
+
+	def get_position(self, game):
+		return Position(
+			hands=[bytes(hand.astype(np.uint8)) for hand in self.hands[game]],
+			draw_pile=bytes(self.draw_pile[game, :self.draw_count[game]].astype(np.uint8)),
+			discard_pile=bytes(self.discard_pile[game, :self.discard_count[game]].astype(np.uint8)),
+			current_color=int(self.current_color[game]),
+			current_player=int(self.current_player[game]),
+			previous_player=int(self.previous_player[game]) if self.previous_player[game] != -1 else None,
+			direction=int(self.direction[game]),
+			draw_amount=int(self.draw_amount[game]),
+		)
+
+	## Cross-check
+
+	def cross_check(self):
+
+		# Replay recorded games through uno.Game, which must accept every play
+		# and end in the same position. Returns a list of mismatch descriptions.
+
+		mismatches = []
+
+		for game, record in self.records.items():
+
+			# Running out of cards isn't something uno.Game handles
+			if self.ran_out[game]:
+				continue
+
+			replay = ReplayGame(record.shuffles)
+			replay.apply_configs(self.configs)
+			replay.load_position(self.num_players, record.start)
+
+			for play_number, play in enumerate(record.plays):
+				result = replay.play(replay.current_player, play)
+				if not result.success:
+					mismatches.append('game {} play {}: uno.Game refused {} ({})'.format(game, play_number, play, result.fail_reason))
+					break
+			else:
+				expected = (self.winner[game] if self.winner[game] != -1 else None,
+					self.current_player[game], self.direction[game], self.draw_amount[game],
+					self.current_face[game], self.current_color[game],
+					[bytes(hand.astype(np.uint8)) for hand in self.hands[game]])
+				got = (replay.winner, replay.current_player, replay.direction, replay.draw_amount,
+					replay.current_face, replay.current_color,
+					[bytes(hand) for hand in replay.player_hands])
+
+				if expected != got:
+					mismatches.append('game {}: simulator ended at {}, uno.Game at {}'.format(game, expected, got))
+
+		return mismatches
+
+class ReplayGame(uno.Game):
+
+	# uno.Game that takes the order of reshuffled cards from a recording
+
+	def __init__(self, shuffles):
+		super().__init__()
+		self.recorded_shuffles = list(shuffles)
+
+	def load_position(self, num_players, position):
+
+		self.num_players = num_players
+
+		self.player_hands = [bytearray(hand) for hand in position.hands]
+		self.make_hand_indexes(num_players)
+
+		for player in range(num_players):
+			self.index_hand(player)
+
+		self.set_piles(position.draw_pile, position.discard_pile[:-1])
+		self.set_current_face(position.discard_pile[-1])
+		self.current_color = position.current_color
+
+		self.current_player = position.current_player
+		self.previous_player = position.previous_player
+		self.direction = position.direction
+		self.draw_amount = position.draw_amount
+
+	def shuffle_cards(self):
+		cards = self.recorded_shuffles.pop(0)
+		assert sorted(cards) == sorted(self.draw_pile)
+		self.set_piles(cards, self.discard_pile)
+
+Record = namedtuple('Record', ['start', 'plays', 'shuffles'])
+Position = namedtuple('Position', ['hands', 'draw_pile', 'discard_pile', 'current_color',
+	'current_player', 'previous_player', 'direction', 'draw_amount'])
+Results = namedtuple('Results', ['num_games', 'num_finished', 'num_ran_out', 'wins_per_seat', 'average_plays'])
+
+def make_playable_table(rules):
+
+	# Playable faces for every situation, indexed by current kind, current
+	# color, whether draws are pending, and the drawn face (NO_FACE if none).
+	# Filled from uno's own playability, so both follow the same rules.
+	# Only the drawn face can be played once drawn, as in uno.
+
+	table = np.zeros((uno.NUM_KINDS, uno.NUM_COLORS, 2, uno.NUM_FACES + 1, uno.NUM_FACES), dtype=bool)
+	bits = 1 << np.arange(uno.NUM_FACES, dtype=object)
+
+	for kind in range(uno.NUM_KINDS):
+		for color in range(uno.NUM_COLORS):
+			for drawing in range(2):
+				situation = (kind, color, bool(drawing))
+				playable = uno.make_playability((rules.draw_4_on_draw_4, rules.draw_2_on_draw_4), situation).playable
+				table[kind, color, drawing, NO_FACE] = (playable & bits) != 0
+
+				for drawn_face in range(uno.NUM_FACES):
+					table[kind, color, drawing, drawn_face] = (playable & (1 << drawn_face) & bits) != 0
+
+	return table
+
+def main():
+
+	parser = argparse.ArgumentParser(description='Simulate many UNO games at once.')
+	parser.add_argument('--games', type=int, default=10000, help='number of games')
+	parser.add_argument('--players', type=int, default=4, help='number of players per game')
+	parser.add_argument('--config', action='append', default=[], metavar='CONFIG=VALUE', help='room config, can be repeated')
+	parser.add_argument('--seed', type=int, default=0, help='random seed')
+	parser.add_argument('--max-plays', type=int, default=1000, help='plays after which a game is given up')
+	parser.add_argument('--cross-check', type=int, default=0, metavar='N', help='replay N games through uno.Game')
+	args = parser.parse_args()
+
+	simulator = Simulator(args.games, args.players, uno.parse_configs(args.config),
+		seed=args.seed, max_plays=args.max_plays, num_recorded=args.cross_check)
+
+	start_time = time.perf_counter()
+	results = simulator.run()
+	elapsed = time.perf_counter() - start_time
+
+	print('Games: {} ({} finished, {} ran out of cards)'.format(results.num_games, results.num_finished, results.num_ran_out))
+	print('Games/sec: {:.0f}'.format(results.num_games / elapsed))
+	print('Average plays: {:.1f}'.format(results.average_plays))
+	for seat, wins in enumerate(results.wins_per_seat):
+		print('Seat {} wins: {:.1%}'.format(seat, wins / max(results.num_finished, 1)))
+
+	if args.cross_check:
+		mismatches = simulator.cross_check()
+		print('Cross-check: {} games replayed, {} mismatches'.format(len(simulator.records), len(mismatches)))
+		for mismatch in mismatches:
+			print(mismatch)
+
+if __name__ == "__main__":
+	main()